@@ -2,6 +2,7 @@
 import sys
 import os
 import importlib
+import inspect
 import argparse
 from pathlib import Path
 
@@ -78,13 +79,66 @@ def get_args():
         help="Output progress and logging messages."
     )
 
+    parser.add_argument(
+        "--points-method",
+        default=None,
+        help="Algorithm used to find the maximum points for each item class: "
+             "auto (picks brute, vectorized or clusters from the exact number of items, default), "
+             "clusters (exact, independent stat clusters combined by DP), "
+             "buckets (exact, DP over capped stat totals), "
+             "frontier (exact, scores cached Pareto frontiers of the stat totals), "
+             "bnb (exact branch and bound), maxsat (exact, RC2 MaxSAT solver), "
+             "vectorized (exhaustive search scored in numpy blocks), "
+             "incremental (exhaustive search carrying partial stat totals), "
+             "mitm (exact, meet in the middle of prefix and suffix sides), brute (exhaustive search), "
+             "or local (fast heuristic, simulated annealing seeded by --points-seed). "
+             "Item types can use different methods, e.g. clusters,RARE=mitm."
+    )
+
+    parser.add_argument(
+        "--points-budget",
+        type=float,
+        metavar="SECONDS",
+        default=None,
+        help="Quick build: item classes that are cheap to solve exactly still are, and the others "
+             "share about SECONDS, starting from greedy items and improving them while time is left. "
+             "Scale bars that aren't proven optimal are flagged with a comment in the filter. "
+             "Can't be combined with --points-method."
+    )
+
+    parser.add_argument(
+        "--points-seed",
+        type=int,
+        default=0,
+        help="Seed of the heuristic local max points method (the same seed always gives the same filter)."
+    )
+
+    parser.add_argument(
+        "--no-region-cache",
+        action="store_true",
+        help="Learn the item regions from the config files again, instead of reusing the regions "
+             "cached by a previous build with the same config files."
+    )
+
+    parser.add_argument(
+        "--no-points-cache",
+        action="store_true",
+        help="Search for the maximum points of every item class again, instead of reusing "
+             "the results of previous builds for item classes that haven't changed."
+    )
+
     parser.add_argument(
         "target",
         type=str,
         help="Target filename."
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.points_budget is not None and args.points_method is not None:
+        parser.error("--points-budget picks the max points methods itself, so it can't be combined with --points-method")
+    if args.points_method is None:
+        args.points_method = "auto"
+    return args
 
 
 bar = '//'+'-'*100
@@ -93,9 +147,14 @@ def build_filter():
     args = get_args()
     outfh = open(args.target, 'w', encoding='windows-1252')
     outfh.writelines(line+'\n' for line in file_header)
-    walk_structure(structure, outfh, verbose=args.verbose)
+    options = {'points_method': args.points_method,
+               'points_budget': args.points_budget,
+               'points_seed': args.points_seed,
+               'region_cache': not args.no_region_cache,
+               'points_cache': not args.no_points_cache}
+    walk_structure(structure, outfh, verbose=args.verbose, options=options)
         
-def walk_structure(source, outfh, verbose):
+def walk_structure(source, outfh, verbose, options=None):
     for section_name, section_source in source.items():
         header =  ['',
                    bar,
@@ -104,15 +163,17 @@ def walk_structure(source, outfh, verbose):
                   '']
         outfh.writelines(line+'\n' for line in header)
         if isinstance(section_source, (str, os.PathLike)):
-            section = parse_source(section_source, verbose=verbose)
+            section = parse_source(section_source, verbose=verbose, options=options)
             outfh.writelines(line+'\n' for line in section)
         elif isinstance(section_source, dict):
-            section = walk_structure(section_source, outfh, verbose)
+            section = walk_structure(section_source, outfh, verbose, options)
         else:
             raise ValueError("Unknown datatype in filter structure definition: {}".format(section_source))
         
 
-def parse_source(sourcefile, verbose=False):
+def parse_source(sourcefile, verbose=False, options=None):
+    if options is None:
+        options = {}
     sourcefile = Path(sourcefile)
     
     if sourcefile.suffix == '.filter':
@@ -130,7 +191,10 @@ def parse_source(sourcefile, verbose=False):
         if not hasattr(module, 'build'):
             raise AttributeError(f'{sourcefile} has no "build" function')
         
-        return [Aliaser.process(line) for line in module.build(verbose=verbose)]
+        # Only hand each generator the build options it knows about
+        parameters = inspect.signature(module.build).parameters
+        kwargs = {k: v for k, v in options.items() if k in parameters}
+        return [Aliaser.process(line) for line in module.build(verbose=verbose, **kwargs)]
     else:
         raise ValueError(f"Unknown filetype in filter structure definition: {sourcefile}")
 
@@ -2,12 +2,13 @@
 
 import re
 import sys
+import json
+import hashlib
 from copy import copy
+from itertools import combinations
 from types import SimpleNamespace
 from pathlib import Path
 
-from pysat.solvers import Glucose3
-
 HERE = Path(__file__).parent
 PROJECT_DIR = HERE / '..'
 PROJECT_DIR = PROJECT_DIR.resolve()
@@ -15,6 +16,13 @@ CONFIG_DIR = PROJECT_DIR / 'config'
 CONFIG_DIR = CONFIG_DIR.resolve()
 DATA_DIR = PROJECT_DIR / 'data'
 DATA_DIR = DATA_DIR.resolve()
+CACHE_DIR = PROJECT_DIR / '.cache'
+
+# Part of the region cache key: bump it whenever a change to the engine changes the regions it learns
+ENGINE_VERSION = 2
+
+# Item qualities that regions are checked against (see find_region_qualities)
+QUALITIES = ['MAG', 'RARE', 'CRAFT']
 
 def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
                   subset_config = DATA_DIR / 'item_groups_subset.csv',
@@ -23,14 +31,37 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
                   suffix_config = DATA_DIR / 'suffixes.csv',
                   craft_config = DATA_DIR / 'crafting.csv',
                   point_config = CONFIG_DIR / 'points.csv',
-                  verbose = False):
+                  verbose = False,
+                  cache_dir = CACHE_DIR):
     """
     Read various configuration files and produce a set of equivalency regions
     (i.e. groupings of items) defined by the filter rules and known disjoint/subset
     relationships, such that the same set of rules are applied to all items within
     a region. In other words, find all possible different combinations of point
     sources that could apply to a given item group.
+    The regions are cached in cache_dir (None disables the cache),
+    and are only learned again when a config file or the ENGINE_VERSION changes.
     """
+    # Parse the rules
+    rules = list(read_affixes(prefix_config, kind='prefix'))
+    rules.extend( list(read_affixes(suffix_config, kind='suffix')) )
+    rules.extend( list(read_affixes(craft_config, kind='craft')) )
+    rules.extend( list(read_points(point_config)) )
+    if verbose:
+        print(f'{len(rules)} rules input')
+
+    # Reuse the regions learned from the same config files, if possible
+    cache_file = None
+    if cache_dir is not None:
+        configs = [disjoint_config, subset_config, composite_config,
+                   prefix_config, suffix_config, craft_config]
+        cache_file = Path(cache_dir) / f'regions_{region_cache_key(configs, point_config)}.json'
+        output_regions = load_cached_regions(cache_file, rules)
+        if output_regions is not None:
+            if verbose:
+                print(f'Loaded {len(output_regions)} regions from {cache_file}')
+            return rules, output_regions
+
     # Read various config files
     disjoint_pairs = list(read_disjoint(disjoint_config))
     subset_pairs = list(read_subset(subset_config))
@@ -48,14 +79,16 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
     encoder.add_descriptors(descriptors)
     encoder.encode_global_constraints(disjoint_pairs, subset_pairs, composite_descriptors)
 
-    # Parse the rules
-    rules = list(read_affixes(prefix_config, kind='prefix'))
-    rules.extend( list(read_affixes(suffix_config, kind='suffix')) )
-    rules.extend( list(read_affixes(craft_config, kind='craft')) )
-    rules.extend( list(read_points(point_config)) )
-    if verbose:
-        print(f'{len(rules)} rules input')
+    # Rules with the same (normalized) condition form a class, which is encoded once.
+    # The other members of the class become aliases of its first rule.
+    classes = {}
     for rule in rules:
+        classes.setdefault(normalize_ast(rule.to_ast()), []).append(rule)
+    classes = list(classes.values())
+
+    # Encode the rules
+    for members in classes:
+        rule = members[0]
         try:
             encoder.encode_rule(rule)
         except ValueError as e:
@@ -63,12 +96,20 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
             print(f"Bad {rule.kind} rule :", rule, file=sys.stderr)
             print('', file=sys.stderr)
             raise e
+        for member in members[1:]:
+            encoder.encode_alias(member, rule)
     if verbose:
-        print(f'{len(encoder.var2rule)} rules encoded')
+        print(f'{len(encoder.var2rule)} rules encoded ({len(classes)} distinct conditions)'
+              f' as {encoder.count_clauses()} clauses over {len(encoder.var2ast)} variables')
 
     # Initialize the solver with the encoded data
     solver = encoder.init_solver()
 
+    # Conditions that are written differently can still be equivalent under the global constraints
+    classes = merge_equivalent_classes(encoder, classes)
+    if verbose:
+        print(f'{len(classes)} classes of equivalent rules')
+
     # Ensure that none of the literals are broke => indicates misconfiguration.
     essentials = ['ARMOR', 'HELM', 'CIRC', 'CHEST', 'SHIELD', 'GLOVES', 'BOOTS',
                   'BELT', 'amu', 'rin', 'WEAPON', '1H', '2H', 'MACE', 'TMACE',
@@ -85,36 +126,81 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
     # The region is still constrained by the global constrains
     # present in config files and encoded in the solver.
     regions = [Region()]
-
-    # Use each rule to split or refine each existing region.
-    for rule in rules:
+    # For each region: a satisfying assignment of its assumptions (from the solve call that created the region),
+    # and the literals that unit propagation derives from its assumptions (None until they are needed)
+    solver.solve()
+    states = [(set(solver.get_model()), None)]
+    Npropagate = 0
+    Nsolve = 1
+    Nbaseline = 0 # solve calls of testing every rule (not class) both ways in every region
+
+    # Use each class of equivalent rules to split or refine each existing region.
+    for members in classes:
+        rule = members[0]
+        # One rule of every differently written condition in the class, whose literals go into the assumptions
+        # (so that the characteristics can still be written with the simplest of them)
+        written = list({normalize_ast(member.to_ast()): member for member in reversed(members)}.values())[::-1]
         new_regions = []
-        for reg in regions:
+        new_states = []
+        for reg, (model, implied) in zip(regions, states):
             # Test if this rule can either true of false within the existing region.
             # 1. The current rule could be either true or false in this region -> make 2 new regions for each case.
             # 2. The current rule must always be true in this region -> append the true state of this rule as a constraint on the region.
             # 3. The current rule must always be false in this region -> append the false state of this rule as a constraint on the region.       
             base_assumps = list(reg.assumptions)
-
-            # Branch 1: rule evaluates to TRUE in this region
-            assume_true = base_assumps + [rule.var]
-            if solver.solve(assumptions=assume_true):
-                new_region = reg.make_copy()
-                new_region.add_assumption(rule.var)
-                new_region.add_applicable(rule)
-                new_regions.append(new_region)
-
-            # Branch 2: rule evaluates to FALSE in this region
-            assume_false = base_assumps + [-rule.var]
-            if solver.solve(assumptions=assume_false):
+            Nbaseline += 2 * len(members)
+
+            # Unit propagation settles the rules that the region's assumptions force without a search
+            if implied is None:
+                _, implied = solver.propagate(assumptions=base_assumps)
+                implied = set(implied)
+                Npropagate += 1
+            if rule.var in implied:
+                branches = [(rule.var, model)]
+            elif -rule.var in implied:
+                branches = [(-rule.var, model)]
+            else:
+                # The region's model already shows that one of the branches is possible,
+                # so only the other one needs a full solve
+                branches = []
+                for lit in (rule.var, -rule.var):
+                    if lit in model:
+                        branches.append((lit, model))
+                    else:
+                        Nsolve += 1
+                        if solver.solve(assumptions=base_assumps + [lit]):
+                            branches.append((lit, set(solver.get_model())))
+
+            for lit, branch_model in branches:
+                # Branch 1: rule evaluates to TRUE in this region
+                # Branch 2: rule evaluates to FALSE in this region
                 new_region = reg.make_copy()
-                new_region.add_assumption(-rule.var)
+                for member in written:
+                    new_region.add_assumption(member.var if lit > 0 else -member.var)
+                if lit > 0:
+                    for member in members:
+                        new_region.add_applicable(member)
                 new_regions.append(new_region)
+                # Literals implied before are still implied, but a new assumption can imply more
+                new_states.append((branch_model, implied if lit in implied else None))
 
         regions = new_regions # Discard the prior generation of regions
+        states = new_states
+    # Order the assumptions as if every rule had split the regions in turn:
+    # each condition's literal goes where its last rule is (simplify_region_literals keeps the later literals)
+    position = {}
+    for i, rule in enumerate(rules):
+        position[normalize_ast(rule.to_ast())] = i
+    position = {member.var: position[normalize_ast(member.to_ast())] for members in classes for member in members}
+    for reg in regions:
+        reg.assumptions.sort(key=lambda lit: position[abs(lit)])
+    if verbose:
+        print(f'Split {len(regions)} regions with {Nsolve} solve and {Npropagate} propagate calls'
+              f' (instead of {Nbaseline} solve calls)')
 
     # Simplify regions by pruning redundant rules
-    regions = [simplify_region_literals(solver, region) for region in regions]
+    simplify_stats = SimpleNamespace(solves=0, assumptions=0)
+    regions = [simplify_region_literals(encoder, region, stats=simplify_stats) for region in regions]
 
     for i, region in enumerate(regions):
         if verbose:
@@ -141,7 +227,7 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
         region.assumptions = new_assumptions
         if verbose:
             print('Expanded Assumptions:', region.assumptions)
-        region = simplify_region_literals(solver, region)
+        region = simplify_region_literals(encoder, region, stats=simplify_stats)
         if verbose:
             print('New Assumptions:', region.assumptions)
 
@@ -155,14 +241,108 @@ def learn_regions(disjoint_config = DATA_DIR / 'item_groups_disjoint.csv',
         if verbose:
             sanity_check(encoder, region)
             print()
+    if verbose:
+        print(f'Simplified {simplify_stats.assumptions} assumptions with {simplify_stats.solves} solve calls'
+              f' (instead of at least {simplify_stats.assumptions}, one per assumption)')
 
     # Discard the empty region (typically the last region, where all rules are false)
     regions = [r for r in regions if r.count_rules()]
+
+    # Find the qualities items of each region can have (e.g. there are no rare charms or crafted jewels)
+    quality_vars = encoder.encode_quality_constraints(rules)
+    for i, region in enumerate(regions):
+        region.qualities = find_region_qualities(encoder, region, quality_vars)
+        if verbose and region.qualities != QUALITIES:
+            print(f"Region {i} ({region.characteristic}) can only be {', '.join(region.qualities) or 'nothing'}")
+    if cache_file is not None:
+        save_cached_regions(cache_file, rules, regions)
+        if verbose:
+            print(f'Saved {len(regions)} regions to {cache_file}')
     # Output frozen copy of regions for actually working with
     output_regions = [r.frozen_copy(encoder.var2rule) for r in regions]
     return rules, output_regions
 
 
+def region_cache_key(configs, point_config):
+    """
+    Hash of the config files' contents and the ENGINE_VERSION.
+    The thresholds of the point rules don't change the regions, so they are left out of the hash
+    (tuning them in point_config keeps using the cached regions).
+    """
+    digest = hashlib.sha256(f'engine {ENGINE_VERSION}'.encode())
+    point_rules = '\n'.join('\t'.join(line.split('\t')[:7]) for line in Path(point_config).read_text().splitlines())
+    for content in [Path(config).read_bytes() for config in configs] + [point_rules.encode()]:
+        digest.update(f'\n{len(content)}\n'.encode())
+        digest.update(content)
+    return digest.hexdigest()[:16]
+
+def read_json_cache(cache_file, default=None):
+    """Contents of a JSON cache file, or default if it is missing or unreadable."""
+    try:
+        with open(cache_file, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return default
+
+def write_json_cache(cache_file, data):
+    """Store data in a JSON cache file, creating its directory if needed."""
+    cache_file = Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename, so that an interrupted build can't leave half a cache behind
+    tmp_file = cache_file.with_suffix('.tmp')
+    with open(tmp_file, 'w') as fh:
+        json.dump(data, fh, separators=(',', ':'))
+    tmp_file.replace(cache_file)
+
+def save_cached_regions(cache_file, rules, regions):
+    """
+    Store the learned regions as their assumptions, characteristic, qualities and applicable rule variables,
+    along with the variable of every rule (in the order the rules were read).
+    Replaces any region cache learned from older config files.
+    """
+    cache_file = Path(cache_file)
+    cached = {'engine_version': ENGINE_VERSION,
+              'rule_vars': [rule.var for rule in rules],
+              'regions': [{'assumptions': list(r.assumptions),
+                           'prefixes': list(r.applicable_prefixes),
+                           'suffixes': list(r.applicable_suffixes),
+                           'crafts': list(r.applicable_crafts),
+                           'points': list(r.applicable_points),
+                           'characteristic': r.characteristic,
+                           'qualities': r.qualities} for r in regions]}
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    for stale in cache_file.parent.glob('regions_*.json'):
+        stale.unlink()
+    write_json_cache(cache_file, cached)
+
+def load_cached_regions(cache_file, rules):
+    """
+    Frozen regions (see Region.frozen_copy) from a region cache file, or None if there is no usable cache.
+    Registers the cached variable of every rule, as learning the regions would have.
+    """
+    cached = read_json_cache(cache_file)
+    if cached is None:
+        return None
+    if cached.get('engine_version') != ENGINE_VERSION or len(cached['rule_vars']) != len(rules):
+        return None
+
+    var2rule = {}
+    for rule, var in zip(rules, cached['rule_vars']):
+        rule.register(var)
+        if var is not None:
+            var2rule[var] = rule
+    regions = []
+    for r in cached['regions']:
+        region = Region(ass=r['assumptions'],
+                        pre=r['prefixes'],
+                        suf=r['suffixes'],
+                        cra=r['crafts'],
+                        pts=r['points'],
+                        char=r['characteristic'],
+                        qual=r['qualities'])
+        regions.append(region.frozen_copy(var2rule))
+    return regions
+
 def read_disjoint(config):
     """Reads which item groups overlap from config file, yields all disjoint pairs of item groups."""
     fh = open(config, 'r')
@@ -416,17 +596,23 @@ def build_sat_encoder():
     - register descriptors
     - encode global constraints
     - encode rules (Tseitin)
-    - build a PySAT solver when ready
+    - hand over its PySAT solver when ready
+    All clauses go into one incremental solver as they are encoded.
     """
+    # Only import pysat when regions actually need to be learned (not on region cache hits)
+    from pysat.solvers import Glucose3
+
     desc2var = {} # Mapping from literal names (e.g. AXE) to variable IDs
     var2cond = {} # Mapping from variable IDs to rule conditional statements (str)
     var2ast = {} # Mapping from variable IDs to AST
     var2rule = {} # Mapping or variable IDs to source rules
     var2children = {}
+    node_vars = {} # Normalized ASTs (see normalize_ast) -> variables of their gates, shared by all rules
     next_var_id = 1 # PySAT  uses integers for variables, starting with 1, with negative values indicationg NOT/false
     clauses = [] # Input to the solver
     global_clause_count = 0
-    solver = None
+    solver = Glucose3() # Incremental: checks every rule as it is encoded, and learns the regions afterwards
+    solver_ready = False
 
     def new_var(ast=None):
         # Defines a new variable for some node.
@@ -479,10 +665,36 @@ def build_sat_encoder():
             clauses.append([-va]+vparts)
 
         global_clause_count = len(clauses)
+        solver.append_formula(clauses)
         return clauses
 
     def get_global_clauses():
         return clauses[:global_clause_count]
+
+    def count_clauses():
+        return len(clauses)
+
+    def encode_quality_constraints(rules):
+        """
+        Register the item QUALITIES as descriptors, constrained by what the encoded rules allow:
+        - an item has at most one quality
+        - a magic item can roll some affix, and a rare item some affix that isn't magic only
+        - a crafted item is the base of some craft recipe
+        Returns the mapping of qualities to their variables.
+        """
+        add_descriptors(QUALITIES)
+        quality_vars = {quality: desc2var[quality] for quality in QUALITIES}
+        affixes = [rule.var for rule in rules if rule.kind in ('prefix', 'suffix')]
+        rare_affixes = [rule.var for rule in rules if rule.kind in ('prefix', 'suffix') and not rule.fields['magic_only']]
+        crafts = [rule.var for rule in rules if rule.kind == 'craft']
+
+        quality_clauses = [[-quality_vars[a], -quality_vars[b]] for a, b in combinations(QUALITIES, 2)]
+        quality_clauses.append([-quality_vars['MAG']] + affixes)
+        quality_clauses.append([-quality_vars['RARE']] + rare_affixes)
+        quality_clauses.append([-quality_vars['CRAFT']] + crafts)
+        clauses.extend(quality_clauses)
+        solver.append_formula(quality_clauses)
+        return quality_vars
     
     def encode_rule(rule):
         """
@@ -504,24 +716,39 @@ def build_sat_encoder():
         var2cond[v_root] = condition_str
         var2rule[v_root] = rule
 
-        # Build a temporary solver to test the rule
-        # using global_clauses, rule_clauses, and v_root
-        s = Glucose3()
-        s.append_formula(get_global_clauses()) # Global constraints from disjoint & subset files
-        s.append_formula(rule_clauses) # Constraints from rule logic
+        # Test the rule in the solver, which already holds the global constraints and the earlier rules.
+        # The rule's clauses only apply while their activation literal is assumed.
+        activation = new_var()
+        solver.append_formula([clause + [-activation] for clause in rule_clauses])
 
         # Check to see if this the rule can ever return True
-        s.add_clause([v_root])
-
-        if s.solve():
-            # Rule is satisfiable. Add it's logic to the growing list of clauses.
+        if solver.solve(assumptions=[activation, v_root]):
+            # Rule is satisfiable. Add it's logic to the growing list of clauses, for good.
             clauses.extend( rule_clauses )
+            solver.add_clause([activation])
         else:
             # Rule is unsatisfiable. It either contradicts possible combinations or has an internal paradox.
+            solver.add_clause([-activation])
             raise ValueError(f"Condition is unsatisfiable: {condition_str}")
         
         return ast, v_root
     
+    def encode_alias(rule, representative):
+        """
+        Encode a rule whose condition is equivalent to that of an already encoded rule,
+        as a variable that is simply equal to the representative's.
+        """
+        v = new_var(ast=var2ast[representative.var])
+        rule.register(v)
+        var2cond[v] = rule.condition_str
+        var2rule[v] = rule
+        var2children[v] = var2children[representative.var]
+        # v ↔ representative
+        alias_clauses = [[-v, representative.var], [v, -representative.var]]
+        clauses.extend(alias_clauses)
+        solver.append_formula(alias_clauses)
+        return v
+
     def tseitin_encode(node, is_root=False):
         """Converts a boolean circuit/logical formula in AST format into an equisatisfiable formula in CNF format."""
         # AST format: logical operators = nodes in a decision tree = gates in a circuit
@@ -532,9 +759,24 @@ def build_sat_encoder():
         # If all the clauses of each node are satisfiable (i.e. can be true for some set of inputs), then the overall circuit must be satisfiable.
         # Therefore, the conjunction (clauses for node 1 AND clauses for node 2 AND clauses for node 3. . .) of all clauses is equisatisfiable with the input formula.
         # Essentially, break down the logical circuit into its smallest constituent parts and if all of them can be satisfied then the entire circuit can be satisfied.
+        # Structurally identical subformulas (up to the order and nesting of and/or children)
+        # are encoded once, and their gate is shared by every rule that contains them.
         node_clauses = []
         
         kind = node[0]
+        key = normalize_ast(node)
+        if kind != 'var' and key in node_vars:
+            v_shared = node_vars[key]
+            if not is_root:
+                return v_shared, node_clauses
+            # Rules still need a variable of their own, which simply equals the shared gate
+            v_out = new_var(ast=node)
+            var2children[v_out] = var2children[v_shared]
+            # v_out ↔ v_shared
+            node_clauses.append([-v_out,  v_shared])
+            node_clauses.append([ v_out, -v_shared])
+            return v_out, node_clauses
+
         if kind == 'var':
             # This node is a literal - a leaf on the tree.
             # No clauses because it is assumed to be a proper variable that can be either True or False.
@@ -608,14 +850,16 @@ def build_sat_encoder():
         else:
             raise ValueError(f"Unknown AST kind {kind}")
 
+        if kind != 'var':
+            node_vars[key] = v_out
         return v_out, node_clauses
 
     def init_solver():
-        nonlocal solver
-        if solver:
+        # The solver already holds every clause, so it is simply handed over
+        nonlocal solver_ready
+        if solver_ready:
             raise ValueError("Solver has already been initialized.")
-        solver = Glucose3()
-        solver.append_formula(clauses)
+        solver_ready = True
         return solver
 
 
@@ -623,8 +867,12 @@ def build_sat_encoder():
     return SimpleNamespace(
         add_descriptors=add_descriptors,
         encode_global_constraints=encode_global_constraints,
+        encode_quality_constraints=encode_quality_constraints,
         encode_rule=encode_rule,
+        encode_alias=encode_alias,
+        new_var=new_var,
         get_global_clauses=get_global_clauses,
+        count_clauses=count_clauses,
         tseitin_encode=tseitin_encode,
         desc2var=desc2var,
         var2cond=var2cond,
@@ -642,13 +890,14 @@ class Region(object):
     Rules which apply to the region are stored by reference
     as their integer variables to ensure immutability (uniqueness).
     """
-    def __init__(self, ass=[], pre=set(), suf=set(), cra=set(), pts=set(), char=''):
+    def __init__(self, ass=[], pre=set(), suf=set(), cra=set(), pts=set(), char='', qual=None):
         self.assumptions = ass
         self.applicable_prefixes = pre
         self.applicable_suffixes = suf
         self.applicable_crafts = cra
         self.applicable_points = pts
         self.characteristic = char
+        self.qualities = list(QUALITIES) if qual is None else qual
 
     def add_assumption(self, var):
         self.assumptions.append(var)
@@ -683,7 +932,8 @@ class Region(object):
                    suf=copy(self.applicable_suffixes),
                    cra=copy(self.applicable_crafts),
                    pts=copy(self.applicable_points),
-                   char=copy(self.characteristic))
+                   char=copy(self.characteristic),
+                   qual=copy(self.qualities))
         return c
     
     def count_rules(self):
@@ -709,8 +959,73 @@ class Region(object):
                                applicable_suffixes=ASuf,
                                applicable_crafts=ACra,
                                applicable_points=APts,
-                               characteristic=copy(self.characteristic))
+                               characteristic=copy(self.characteristic),
+                               qualities=copy(self.qualities))
+
+
+def normalize_ast(ast):
+    """
+    Canonical form of an AST, for finding conditions that are the same up to their notation:
+    nested ands (ors) are flattened into one n-ary node with sorted, unique children,
+    and double negations are removed.
+    """
+    kind = ast[0]
+    if kind == 'var':
+        return ast
+    elif kind == 'not':
+        child = normalize_ast(ast[1])
+        if child[0] == 'not':
+            return child[1]
+        return ('not', child)
+    elif kind in ('and', 'or'):
+        children = set()
+        for child in ast[1:]:
+            child = normalize_ast(child)
+            if child[0] == kind:
+                children.update(child[1:])
+            else:
+                children.add(child)
+        if len(children) == 1:
+            return children.pop()
+        return (kind, *sorted(children))
+    else:
+        raise ValueError(f"Unknown AST kind {kind}")
+
+def merge_equivalent_classes(encoder, classes):
+    """
+    Merge the classes of rules (see learn_regions) whose conditions are equivalent under the global constraints.
+    Candidates agree on a sample of models of the encoded rules, and are then confirmed by the solver.
+    """
+    solver = encoder.get_solver()
+    roots = [members[0].var for members in classes]
+    # Models with every root true and with every root false
+    models = []
+    for v in roots:
+        for lit in (v, -v):
+            if solver.solve(assumptions=[lit]):
+                models.append(set(solver.get_model()))
+
+    merged = {} # Sample values -> classes, whose roots are pairwise inequivalent
+    for members in classes:
+        v = members[0].var
+        candidates = merged.setdefault(tuple(v in model for model in models), [])
+        for other in candidates:
+            u = other[0].var
+            # Equivalent iff u and v can't differ
+            if not solver.solve(assumptions=[u, -v]) and not solver.solve(assumptions=[-u, v]):
+                other.extend(members)
+                break
+        else:
+            candidates.append(members)
+    # Keep the order of the first rule of each class
+    return sorted((members for candidates in merged.values() for members in candidates),
+                  key=lambda members: members[0].var)
 
+def find_region_qualities(encoder, region, quality_vars):
+    """The qualities (of QUALITIES) that some item of the region can have."""
+    solver = encoder.get_solver()
+    return [quality for quality in QUALITIES
+            if solver.solve(assumptions=list(region.assumptions) + [quality_vars[quality]])]
 
 def infer_child_states(encoder, region):
     s = encoder.get_solver()
@@ -943,6 +1258,8 @@ def probe_core_for_literal(encoder, lit_name):
     that together with `lit_name` cause a contradiction.
     """
 
+    from pysat.solvers import Glucose3
+
     # --- Build fresh solver with guarded global clauses ---
     s = Glucose3()
     gcs = encoder.get_global_clauses()   # only global disjoint/subset CNF
@@ -1023,8 +1340,13 @@ def probe_core_for_literal(encoder, lit_name):
     print("", file=sys.stderr)
     return
 
-def simplify_region_literals(solver, region):
-    """Attempts to simplify region definitions by removing redundant literals with a greedy algorithm."""
+def simplify_region_literals(encoder, region, minimal=True, stats=None):
+    """
+    Attempts to simplify region definitions by removing redundant literals, guided by UNSAT cores.
+    With minimal=True, literals are tried for deletion in turn until none of them is redundant.
+    Otherwise a single UNSAT core is kept, which is quicker but can leave redundant literals.
+    stats (a SimpleNamespace with solves and assumptions counters) tallies the work, if given.
+    """
     # Regions are defined by the rules (e.g. rule 1 is true in this region, rule 2 is false, rule 3 is true, etc. . .)
     # These assignments are stored in Region.assumptons (positive integers mean true, negative integers mean false).
     # Some rules will be duplicates, or otherwise imply the truth or falseness of another rule.
@@ -1052,20 +1374,51 @@ def simplify_region_literals(solver, region):
     #    the 3rd clause implies nothing about A or B
     # Yet R1=True implies that A=True, thus R1 is in conflict with R2=False
     
-    changed = True
-    while changed:
-        changed = False
-        for i, literal in enumerate(region.assumptions):
-            others = region.assumptions[:i] + region.assumptions[i+1:]
-            if solver.solve(assumptions=others+[-literal]):
+    # Rather than violating one assumption at a time, violate any of them:
+    # the assumptions together with "at least one assumption is false" are always unsatisfiable,
+    # and the UNSAT core of that call is a subset of assumptions which already implies all the others.
+    # Every assumption outside the core is redundant and is dropped in one step.
+    # The core need not be minimal though, so for minimal characteristics each remaining literal is tried for deletion
+    # in turn (earliest first, so the later literals are kept), and each successful deletion trims to its core.
+    # Literals that were kept before a deletion are always in its core, so no literal needs a second test.
+    solver = encoder.get_solver()
+    if stats is not None:
+        stats.assumptions += len(region.assumptions)
+    # A repeated literal is redundant too (the last copy is kept)
+    assumptions = list(dict.fromkeys(reversed(region.assumptions)))[::-1]
+    if not assumptions:
+        return region
+
+    # The "at least one assumption is false" clause only applies while its selector is assumed
+    selector = encoder.new_var()
+    solver.add_clause([-selector] + [-literal for literal in assumptions])
+
+    def core_of(candidates):
+        # The candidates which imply every assumption, or None if they don't.
+        # The solver tries the assumptions in order, so passing them in reverse makes the core favour the later literals.
+        if stats is not None:
+            stats.solves += 1
+        if solver.solve(assumptions=[selector] + candidates[::-1]):
+            return None
+        core = set(solver.get_core())
+        return [literal for literal in candidates if literal in core]
+
+    kept = core_of(assumptions)
+    if minimal:
+        i = 0
+        while i < len(kept):
+            core = core_of(kept[:i] + kept[i+1:])
+            if core is None:
                 # literal is not redundant
-                continue
+                i += 1
             else:
-                # literal is redundant
-                region.assumptions.pop(i)
-                changed = True
-                break # Restart for loop on modified list of assumpitons
+                # literal is redundant, and so is every literal outside the new core
+                i = sum(1 for literal in kept[:i] if literal in core)
+                kept = core
 
+    # Retire the selector for good
+    solver.add_clause([-selector])
+    region.assumptions = kept
     return region
 
 def build_characteristic_ast(region, encoder):
@@ -4,13 +4,24 @@
 # Best to develop in a Linux environment, but top level execution of build_filter.py should work fine.
 
 import sys
+import hashlib
+import time
+import random
 
-from itertools import groupby, product, combinations
-from math import prod, factorial
-from bisect import bisect_left
+from itertools import groupby, product, combinations, chain, islice
+from collections import Counter
+from fractions import Fraction
+from math import prod, factorial, lcm, comb, ceil, exp
+from bisect import bisect_left, bisect_right, insort
 from multiprocessing import Pool, cpu_count
+from types import SimpleNamespace
+from dataclasses import dataclass
+from copy import copy
+from queue import SimpleQueue
 
-from .point_engine import learn_regions
+import numpy as np
+
+from .point_engine import learn_regions, read_json_cache, write_json_cache, CACHE_DIR
 
 ### TO DO
 # the following aliases are ESSENTIAL for this to work
@@ -50,8 +61,8 @@ def write_points(rules):
     return lines
 
 
-def write_max_points(regions, item_type, verbose=False):
-    """Brute force algorithm to calculate the theoretical maximum number of points for each region."""
+def affix_slots(item_type):
+    """Number of prefixes, suffixes, random affixes, and whether a craft recipe is rolled for an item type."""
     if item_type == 'RARE':
         Nprefixes = 3
         Nsuffixes = 3
@@ -69,18 +80,32 @@ def write_max_points(regions, item_type, verbose=False):
         include_crafts = False
     else:
         raise ValueError(f"Unknown item_type {item_type} (should be either CRAFT, RARE, or MAG)")
+    return Nprefixes, Nsuffixes, Naffixes, include_crafts
 
-    nprocs = max(1, cpu_count()-1)
-    
-    scale_bars = []
+ITEM_TYPES = ['MAG', 'RARE', 'CRAFT']
+
+def prepare_max_points(regions, item_type, verbose=False):
+    """
+    Set up the max points search of every region for an item type.
+    Each problem holds the region's affixes and point rules as a scoring table (see compile_scoring_table),
+    and gets its max_points, best affixes, effort and upper_bound filled in by solve_max_points.
+    """
+    Nprefixes, Nsuffixes, Naffixes, include_crafts = affix_slots(item_type)
+
+    problems = []
     for i, region in enumerate(regions):
         # Some regions will represent items that can't be a particular type.
         # (e.g. no crafted jewels or charms)
-        # Deciding which regions certain rarity types apply to is Work though.
-        # So just waste some computation time calculating the theoretical
-        # maximum point value of these nonexistant item classes.
+        # The region engine checks which qualities each region can have,
+        # so there are no max points to search (or scale bars to write) for the others.
+        if item_type not in region.qualities:
+            if verbose:
+                print(f'Skipping {item_type} max points search for region {i}: no such items')
+                print('   Characteristic:', region.characteristic)
+                print()
+            continue
         if verbose:
-            print(f'Computing max points for region {i}')
+            print(f'Preparing {item_type} max points search for region {i}')
             print('   Characteristic:', region.characteristic)
 
         # Assemble affixes by group (with or without magic only)
@@ -90,42 +115,57 @@ def write_max_points(regions, item_type, verbose=False):
         else:
             grouped_affixes = rare_grouped_affixes
 
+        # Affixes that are never better than another affix of the same group can't change the maximum
+        pruned_affixes = prune_dominated_affixes(grouped_affixes, region.applicable_points)
+
         # Print worst case shape of affix categories to help estimate effort required
         if verbose:
-            for category, groups in grouped_affixes.items():
-                if groups:
-                    longest_group = max(groups, key=len)
-                else:
-                    longest_group = []
-                print(f'   {len(groups)}x{len(longest_group)} {category} groups')
-            
-        # Iterating over all possible combinations (especially for crafted items) can take a non-negligible amount of time.
-        # Parallelize this step as much as possibe.
-        max_points = 0
-        best = ({}, [])
-        effort = 0
-        with Pool(nprocs) as p:
-            for points, total_stats, affix_names in p.imap_unordered(
-                    calculate_points,
-                    ((affixes, region.applicable_points)
-                     for affixes in iter_affixes(Nprefixes, Nsuffixes, Naffixes, include_crafts, grouped_affixes)),
-                    chunksize=128
-            ):
-                effort += 1
-                max_points = max(max_points, points)
-                if points == max_points:
-                    best = total_stats, affix_names            
+            for category, groups in pruned_affixes.items():
+                longest_group = max(grouped_affixes[category], key=len, default=[])
+                longest_pruned = max(groups, key=len, default=[])
+                print(f'   {len(groups)}x{len(longest_pruned)} {category} groups'
+                      f' (was {len(grouped_affixes[category])}x{len(longest_group)})')
+            before = count_affix_choices(grouped_affixes)
+            after = count_affix_choices(pruned_affixes)
+            print(f'   Dominance pruning shrank affix choices {before} -> {after} ({before/max(after, 1):.3g}x)')
+            print()
+
+        problems.append(SimpleNamespace(item_type=item_type,
+                                        region=i,
+                                        characteristic=region.characteristic,
+                                        stat_names=region.stats,
+                                        table=compile_scoring_table(pruned_affixes, region.applicable_points),
+                                        slots=(Nprefixes, Nsuffixes, Naffixes, include_crafts),
+                                        max_points=0,
+                                        best=({}, []),
+                                        effort=0,
+                                        upper_bound=0))
+    return problems
 
+def write_max_points(problems, verbose=False):
+    """Write the scale bars of solved max points problems."""
+    scale_bars = []
+    for problem in problems:
+        item_type = problem.item_type
+        max_points = problem.max_points
         # Summarize results
         if verbose:
-            print(f'{effort} possible items explored')
+            print(f'Max {item_type} points for region {problem.region}')
+            print('   Characteristic:', problem.characteristic)
+            print(f'{problem.effort} possible items explored')
             print(f'max points = {max_points}:')
-            print(f'   {', '.join(best[1])}')
-            for s, v in best[0].items():
+            print(f'   {', '.join(problem.best[1])}')
+            for s, v in problem.best[0].items():
                 print(f'   {s} = {v}')
 
+        # Flag the scale bars of heuristic searches, and of searches that ran out of time (see solve_max_points)
+        if problem.upper_bound is None:
+            scale_bars.append(f'// Not proven optimal: {max_points} points found by a heuristic search')
+        elif problem.upper_bound > max_points:
+            scale_bars.append(f'// Not proven optimal: {max_points} points found, at most {problem.upper_bound} possible')
+
         # Formulate the filter scale bar
-        scale_condition = f"{item_type} {region.characteristic}"
+        scale_condition = f"{item_type} {problem.characteristic}"
         scale_bar = ("ItemDisplay[" +
                      scale_condition +
                      "]: %NAME%{%LIGHT_GRAY%" +
@@ -139,45 +179,1542 @@ def write_max_points(regions, item_type, verbose=False):
     scale_bars.append('') # Blank line before start of next code block
     return scale_bars
 
-def calculate_points(args):
-    affixes, region_rules = args
-    # Stats in affixes should be atomic
-    # (i.e. combined with ";" to be split appart)
-    # Stats in points can be combined with "+"
-    
-    # Sum all the stats provided by affixes
-    total_stats = {}
-    affix_names = []
-    for affix in affixes:
-        affix_names.append(affix.fields['affix'])
-        for stat, value in affix.fields['stats'].items():
+def solve_max_points(problems, method='auto', nprocs=None, shard_items=200_000, max_in_flight=None,
+                     cache_file=None, frontier_file=None, budget=None, seed=0, verbose=False):
+    """
+    Find the maximum points of every problem (of any item type) on one pool of worker processes.
+    The method is either a name from MAX_POINTS_METHODS or a mapping of item types to names.
+    The auto method picks one for every problem from its exact number of items (see count_items).
+    The workers receive the scoring tables once, when the pool starts,
+    and the tasks only name a problem (and a shard of it) by index.
+    Exhaustive searches of large problems are split into shards of roughly shard_items items,
+    so that the work can be spread over all the workers.
+    At most max_in_flight tasks (default: two per worker) are queued or running at any time.
+    Problems with the same signature (see problem_signature) are only solved once,
+    and with a cache_file, problems solved by earlier builds aren't searched again.
+    The frontier method keeps its stat frontiers in frontier_file.
+    With a budget (in seconds), auto problems that are cheap to solve exactly (see budget_max_points_method)
+    still are, and the others get an even share of the budget for anytime_max_points;
+    the upper_bound of a problem tells whether its max_points are proven (upper_bound == max_points).
+    Heuristic methods (HEURISTIC_METHODS) are seeded with the seed, item type and region of each problem,
+    and leave the upper_bound of their problems unknown (None).
+    Only proven results are stored in the cache.
+    """
+    if isinstance(method, str):
+        method = {problem.item_type: method for problem in problems}
+    for name in method.values():
+        if name != 'auto' and name not in MAX_POINTS_METHODS:
+            raise ValueError(f"Unknown max points method {name} (should be auto or one of {', '.join(MAX_POINTS_METHODS)})")
+    # The auto method picks a method for every problem from its exact number of items
+    items = [count_items(problem.table, *problem.slots) for problem in problems]
+    methods = [method[problem.item_type] for problem in problems]
+    if budget is not None:
+        methods = [budget_max_points_method(problem, n) if name == 'auto' else name
+                   for problem, name, n in zip(problems, methods, items)]
+    methods = [auto_max_points_method(n) if name == 'auto' else name for name, n in zip(methods, items)]
+    if nprocs is None:
+        nprocs = max(1, cpu_count()-1)
+    if max_in_flight is None:
+        max_in_flight = 2*nprocs
+
+    best_rows = [None for _ in problems]
+    signatures = [problem_signature(problem) for problem in problems]
+    todo = list(range(len(problems)))
+    if cache_file is not None:
+        cache = read_json_cache(cache_file, {})
+        todo = []
+        for i, (problem, signature) in enumerate(zip(problems, signatures)):
+            if signature in cache:
+                problem.max_points, rows, problem.effort = cache[signature]
+                problem.upper_bound = problem.max_points
+                best_rows[i] = None if rows is None else tuple(rows)
+            else:
+                todo.append(i)
+        if verbose:
+            print(f'Reusing {len(problems) - len(todo)} of {len(problems)} max points results from {cache_file}')
+
+    # Many regions only differ in their characteristic once their affixes have been reduced,
+    # so only solve the first problem with each signature and share its result
+    unique = {}
+    for i in todo:
+        unique.setdefault(signatures[i], i)
+    if verbose:
+        print(f'{len(unique)} unique max points problems among the {len(todo)} left to solve')
+        notes = ['' for _ in problems]
+        for i, problem in enumerate(problems):
+            if i not in todo:
+                notes[i] = ' (cached)'
+            elif unique[signatures[i]] != i:
+                notes[i] = f' (same as region {problems[unique[signatures[i]]].region})'
+        print_max_points_plan(problems, items, methods, notes)
+
+    if 'frontier' in methods:
+        # Stat frontiers outlive threshold changes, so they are cached separately from the results
+        attach_frontiers([problems[i] for i in unique.values() if methods[i] == 'frontier'], frontier_file,
+                         used=[problem for problem, name in zip(problems, methods) if name == 'frontier'], verbose=verbose)
+
+    shards = [] # (items per shard, problem index, number of shards, number of prefix group combinations)
+    for i in unique.values():
+        problem = problems[i]
+        NP, NS, NA, include_crafts = problem.slots
+        Nshards = 1
+        Ncombinations = None
+        if methods[i] in SHARDABLE_METHODS:
+            # Shards split the outermost loop: the choice of prefix groups
+            Ncombinations = comb(len(problem.table.prefix_groups), NP)
+            Nshards = max(1, min(Ncombinations, ceil(items[i] / shard_items)))
+        shards.append((items[i] / Nshards, i, Nshards, Ncombinations))
+    # Largest tasks first, so that the small ones fill in the gaps at the end
+    shards.sort(key=lambda s: s[0], reverse=True)
+    if verbose:
+        Ntasks = sum(Nshards for _, _, Nshards, _ in shards)
+        print(f'Solving {len(unique)} max points problems as {Ntasks} tasks on {nprocs} workers'
+              f' ({max_in_flight} in flight)')
+
+    # Anytime searches split the budget evenly, over all the workers
+    Nanytime = sum(1 for i in unique.values() if methods[i] == 'anytime')
+    seconds = None if budget is None else budget * nprocs / max(1, Nanytime)
+
+    def method_options(i):
+        # Extra keyword arguments of the method of a problem
+        if methods[i] == 'anytime':
+            return {'budget': seconds}
+        elif methods[i] in HEURISTIC_METHODS:
+            return {'seed': f'{seed}:{problems[i].item_type}:{problems[i].region}'}
+        return {}
+
+    def iter_tasks():
+        # Tasks are only created when there is room for them in the pool
+        for _, i, Nshards, Ncombinations in shards:
+            if Nshards == 1:
+                yield (methods[i], i, None, method_options(i))
+            else:
+                for k in range(Nshards):
+                    yield (methods[i], i, (k*Ncombinations // Nshards, (k+1)*Ncombinations // Nshards), method_options(i))
+
+    # Only brute force scores Rule objects, the other methods just need the numbers
+    worker_problems = [None for _ in problems]
+    for i in unique.values():
+        table = copy(problems[i].table)
+        if methods[i] != 'brute':
+            table.rows = None
+            table.point_rules = None
+        worker_problems[i] = (table, problems[i].slots)
+
+    if todo:
+        with Pool(nprocs, initializer=init_max_points_worker, initargs=(worker_problems,)) as pool:
+            for i, max_points, rows, effort, upper_bound in imap_bounded(pool, run_max_points_task, iter_tasks(), max_in_flight):
+                problem = problems[i]
+                problem.effort += effort
+                if rows is not None and (best_rows[i] is None or max_points > problem.max_points):
+                    problem.max_points = max_points
+                    best_rows[i] = rows
+                # Shards of exact searches all return their own maximum as the bound
+                if upper_bound is None:
+                    problem.upper_bound = None
+                else:
+                    problem.upper_bound = max(problem.upper_bound, upper_bound, problem.max_points)
+
+    for i in todo:
+        j = unique[signatures[i]]
+        problems[i].max_points = problems[j].max_points
+        problems[i].effort = problems[j].effort
+        problems[i].upper_bound = problems[j].upper_bound
+        best_rows[i] = best_rows[j]
+
+    unproven = [i for i in todo if problems[i].upper_bound is None or problems[i].upper_bound > problems[i].max_points]
+    if budget is not None and verbose:
+        anytime = [i for i in todo if methods[unique[signatures[i]]] == 'anytime']
+        if anytime:
+            print(f"{'type':<6}{'region':>7}{'points':>8}{'bound':>7}")
+            for i in anytime:
+                problem = problems[i]
+                flag = '' if problem.upper_bound == problem.max_points else '  not proven optimal'
+                print(f"{problem.item_type:<6}{problem.region:>7}{problem.max_points:>8}{problem.upper_bound:>7}{flag}")
+        print(f'{len(todo) - len(anytime)} of {len(todo)} max points were cheap enough to solve exactly')
+        if anytime:
+            Nunproven = sum(1 for i in anytime if i in unproven)
+            print(f'{Nunproven} of {len(anytime)} anytime searches ran out of their {seconds:.3g}s budget'
+                  f' before proving the best item optimal')
+    elif verbose and unproven:
+        print(f'{len(unproven)} of {len(todo)} max points were found by heuristic searches (not cached)')
+
+    if cache_file is not None:
+        # Only keep the results this build used, so that the cache doesn't grow with every threshold change
+        kept = {signature: cache[signature] for signature in signatures if signature in cache}
+        for i in todo:
+            if i in unproven:
+                continue
+            rows = best_rows[i]
+            kept[signatures[i]] = (problems[i].max_points, None if rows is None else list(rows), problems[i].effort)
+        if kept != cache:
+            write_json_cache(cache_file, kept)
+
+    for problem, rows in zip(problems, best_rows):
+        if rows is not None:
+            affixes = [affix for row in rows for affix in problem.table.rows[row]]
+            _, total_stats, affix_names = calculate_points((affixes, problem.table.point_rules))
+            problem.best = ({problem.stat_names[stat]: value for stat, value in total_stats.items()}, affix_names)
+    return problems
+
+def problem_signature(problem):
+    """
+    Hash of everything that the max points search of a problem depends on:
+    the affix slots and the numbers in its scoring table, but not the names of its affixes and rules,
+    and the MAX_POINTS_VERSION.
+    """
+    table = problem.table
+    digest = hashlib.sha256(repr((MAX_POINTS_VERSION,
+                                  problem.slots,
+                                  table.prefix_groups,
+                                  table.suffix_groups,
+                                  table.recipes,
+                                  table.constant_points,
+                                  table.rule_values.dtype.str,
+                                  table.rule_values.shape)).encode())
+    digest.update(table.rule_values.tobytes())
+    for positive, negative in zip(table.positive, table.negative):
+        digest.update(repr((positive.tolist(), negative.tolist())).encode())
+    return digest.hexdigest()
+
+def imap_bounded(pool, func, tasks, max_in_flight):
+    """
+    Like pool.imap_unordered(func, tasks, chunksize=1), but only takes the next task from the tasks iterable
+    when fewer than max_in_flight tasks are waiting or running.
+    (imap_unordered queues up the whole iterable as fast as it can, however many tasks it yields.)
+    """
+    finished = SimpleQueue()
+    in_flight = 0
+    tasks = iter(tasks)
+    exhausted = False
+    while True:
+        while not exhausted and in_flight < max_in_flight:
             try:
-                total_stats[stat] += value
-            except KeyError:
-                total_stats[stat] = value
-                
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(func, (task,), callback=finished.put, error_callback=finished.put)
+            in_flight += 1
+        if not in_flight:
+            return
+        result = finished.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+_worker_problems = []
+
+def init_max_points_worker(problems):
+    """Pool initializer: keep the (table, slots) of every problem in the worker process."""
+    global _worker_problems
+    _worker_problems = problems
+
+def run_max_points_task(task):
+    """Worker side of solve_max_points: returns the problem index, max points, best table rows, effort and upper bound."""
+    method, i, shard, options = task
+    table, slots = _worker_problems[i]
+    if method == 'anytime':
+        return (i, *anytime_max_points(table, *slots, **options))
+    if shard is None:
+        max_points, rows, effort = MAX_POINTS_METHODS[method](table, *slots, **options)
+    else:
+        max_points, rows, effort = MAX_POINTS_METHODS[method](table, *slots, shard=shard, **options)
+    if method in HEURISTIC_METHODS:
+        return i, max_points, rows, effort, None
+    return i, max_points, rows, effort, max_points
+
+def count_items(table, NP, NS, NA, include_crafts):
+    """
+    Exact number of items an exhaustive search has to score (the items of iter_affixes),
+    i.e. the ways to pick NP prefix groups, NS suffix groups and NA other groups, one affix from each,
+    times the craft recipes.
+    """
+    # Coefficient of p^NP s^NS a^NA in the product over prefix groups of (1 + size*p + size*a)
+    # and over suffix groups of (1 + size*s + size*a), grown one group at a time
+    counts = {(0, 0, 0): 1}
+    groups = [(0, group) for group in table.prefix_groups] + [(1, group) for group in table.suffix_groups]
+    for kind, group in groups:
+        size = len(group)
+        grown = Counter(counts)
+        for (Np, Ns, Na), n in counts.items():
+            if kind == 0 and Np < NP:
+                grown[(Np+1, Ns, Na)] += n*size
+            if kind == 1 and Ns < NS:
+                grown[(Np, Ns+1, Na)] += n*size
+            if Na < NA:
+                grown[(Np, Ns, Na+1)] += n*size
+        counts = grown
+    items = counts.get((NP, NS, NA), 0)
+    if include_crafts:
+        items *= len(table.recipes)
+    return items
+
+# Method picked for every problem by the 'auto' max points method:
+# brute force scores up to AUTO_BRUTE_ITEMS items, vectorized scoring up to AUTO_VECTORIZED_ITEMS,
+# and larger problems go to the cluster decomposition, whose effort doesn't grow with the number of items
+AUTO_BRUTE_ITEMS = 1_000
+AUTO_VECTORIZED_ITEMS = 100_000
+
+def count_cluster_items(table, NP, NS, NA, include_crafts):
+    """
+    Number of items cluster_max_points scores (at most): for every stat cluster, the ways to pick
+    one affix from up to all the affix slots' worth of its groups, times the craft recipes.
+    """
+    slots = NP + NS + NA
+    items = 0
+    for _, groups in stat_clusters(table):
+        # Coefficients of the product over the cluster's groups of (1 + size*x), up to x^slots
+        counts = [1]
+        for _, group in groups:
+            counts = [n + (counts[k-1]*len(group) if k else 0) for k, n in enumerate(counts + [0])][:slots+1]
+        items += sum(counts)
+    if include_crafts:
+        items *= len(table.recipes)
+    return items
+
+def budget_max_points_method(problem, items):
+    """
+    Max points method of an auto problem in a build with a points budget:
+    the exact auto method if it scores at most AUTO_VECTORIZED_ITEMS items (see count_items and count_cluster_items),
+    otherwise the anytime search.
+    """
+    if items <= AUTO_VECTORIZED_ITEMS:
+        return 'auto'
+    elif count_cluster_items(problem.table, *problem.slots) <= AUTO_VECTORIZED_ITEMS:
+        return 'clusters'
+    return 'anytime'
+
+def auto_max_points_method(items):
+    """Max points method for a problem with this many items (see count_items)."""
+    if items <= AUTO_BRUTE_ITEMS:
+        return 'brute'
+    elif items <= AUTO_VECTORIZED_ITEMS:
+        return 'vectorized'
+    else:
+        return 'clusters'
+
+def print_max_points_plan(problems, items, methods, notes):
+    """Summary table of the number of items and the method of every max points problem."""
+    print(f"{'type':<6}{'region':>7}{'items':>18}  method")
+    for problem, n, name, note in zip(problems, items, methods, notes):
+        print(f"{problem.item_type:<6}{problem.region:>7}{n:>18,}  {name}{note}")
+    print(f'{sum(items):,} items in total')
+    print()
+
+# Results of earlier max points searches (see solve_max_points)
+MAX_POINTS_CACHE = CACHE_DIR / 'max_points.json'
+# Part of every problem signature: bump it whenever a fix to the max points methods can change their results
+MAX_POINTS_VERSION = 2
+FRONTIER_CACHE = CACHE_DIR / 'frontiers.json'
+
+# Memory budget of one block of items in vectorized_max_points
+BLOCK_BYTES = 4 * 2**20
+
+# Every max points method takes a scoring table and the affix slots of the item type,
+# and returns (max points, table rows of the best item, effort).
+# The best rows are None if the item type can't roll any items at all.
+
+def brute_force_max_points(table, NP, NS, NA, include_crafts, shard=None):
+    """Brute force algorithm: score every possible combination of affixes."""
+    grouped_rows = {'prefixes': table.prefix_groups,
+                    'suffixes': table.suffix_groups,
+                    'crafts': [[row] for row in table.recipes]}
+    max_points = 0
+    best = None
+    effort = 0
+    for rows in iter_affixes(NP, NS, NA, include_crafts, grouped_rows, shard):
+        affixes = [affix for row in rows for affix in table.rows[row]]
+        points, _, _ = calculate_points((affixes, table.point_rules))
+        effort += 1
+        max_points = max(max_points, points)
+        if points == max_points:
+            best = tuple(sorted(rows))
+    return max_points, best, effort
+
+def incremental_max_points(table, NP, NS, NA, include_crafts, shard=None):
+    """
+    Same exhaustive search as brute force, without building any item tuples.
+    The stat totals are carried down the nested loops, along with the points of the rules
+    that the remaining loops can't change anymore, so every step only adds one affix.
+    """
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+    contributions = table.rule_values.tolist()
+    touched = [np.flatnonzero(row).tolist() for row in table.rule_values]
+    prefix_groups = table.prefix_groups
+    suffix_groups = table.suffix_groups
+    if include_crafts:
+        recipe_levels = [table.recipes]
+    else:
+        recipe_levels = []
+
+    max_points = 0
+    best = None
+    effort = 0
+    values = [0 for _ in rules]
+    chosen = []
+
+    def search(levels):
+        # One loop per level: the craft recipe, then one affix from each chosen group
+        nonlocal max_points, best, effort
+        level_rules = [sorted({r for row in rows for r in touched[row]}) for rows in levels]
+        # Rules are settled (scored) at the last level that can change them
+        last = {}
+        for d, rule_ids in enumerate(level_rules):
+            for r in rule_ids:
+                last[r] = d
+        settle = [[r for r in rule_ids if last[r] == d] for d, rule_ids in enumerate(level_rules)]
+        Nlevels = len(levels)
+
+        def descend(d, points):
+            nonlocal max_points, best, effort
+            if d == Nlevels:
+                effort += 1
+                max_points = max(max_points, points)
+                if points == max_points:
+                    best = tuple(sorted(chosen))
+                return
+            rule_ids = level_rules[d]
+            base = [values[r] for r in rule_ids]
+            for row in levels[d]:
+                contribution = contributions[row]
+                for r, v in zip(rule_ids, base):
+                    values[r] = v + contribution[r]
+                chosen.append(row)
+                descend(d+1, points + sum(rule_points(*rules[r], values[r], values[r]) for r in settle[d]))
+                chosen.pop()
+            for r, v in zip(rule_ids, base):
+                values[r] = v
+
+        descend(0, sum(rule_points(pos, neg, 0, 0) for r, (pos, neg) in enumerate(rules) if r not in last))
+
+    # Same loops as iter_affixes (and the same shards)
+    if shard is None:
+        shard = (0, None)
+    for p_idxs in islice(combinations(range(len(prefix_groups)), NP), *shard):
+        for s_idxs in combinations(range(len(suffix_groups)), NS):
+            if NA:
+                # Other groups can be used for random craft affixes
+                unfixes = ([g for i, g in enumerate(prefix_groups) if i not in p_idxs] +
+                           [g for i, g in enumerate(suffix_groups) if i not in s_idxs])
+            else:
+                unfixes = []
+            fixed = [prefix_groups[i] for i in p_idxs] + [suffix_groups[i] for i in s_idxs]
+            for random_groups in combinations(unfixes, NA):
+                search(recipe_levels + fixed + list(random_groups))
+    if best is None:
+        return 0, None, effort
+    return max_points + table.constant_points, best, effort
+
+def branch_and_bound_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Exact branch and bound search for the maximum number of points.
+    Returns the same maximum as brute_force_max_points, while skipping
+    every partial item that provably cannot beat the best item found so far.
+    """
+    max_points, best, effort, _ = branch_and_bound_search(table, NP, NS, NA, include_crafts)
+    return max_points, best, effort
+
+class SearchTimeout(Exception):
+    """Raised inside a search that has run past its deadline."""
+
+def branch_and_bound_search(table, NP, NS, NA, include_crafts, start=None, deadline=None):
+    """
+    The search of branch_and_bound_max_points, returning (max points, best rows, effort, upper bound).
+    start is a known (points, rows) item to beat, and past the deadline (a time.monotonic() value)
+    the search stops with the best item so far. The upper bound is then the most points
+    that the craft recipes whose search didn't finish could still reach (or max points if it did finish).
+    """
+    # Any item rolls exactly NP+NS+NA affixes from distinct groups: at least NP prefixes,
+    # at least NS suffixes, and the NA random affixes can come from either side.
+    # So instead of iterating over prefix/suffix/random combinations the search
+    # walks the groups one at a time, either taking one of its affixes or skipping it.
+    slots = NP + NS + NA
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+    # Value that each table row adds to the (summed) stat of every point rule
+    contributions = [tuple(c) for c in table.rule_values.tolist()]
+
+    groups = []
+    for kind, kind_groups in (('prefixes', table.prefix_groups), ('suffixes', table.suffix_groups)):
+        for group in kind_groups:
+            options = [(row, contributions[row]) for row in group]
+            groups.append((kind, options))
+    if include_crafts:
+        # Craft recipes always add all of their mods
+        crafts = [(row, contributions[row]) for row in table.recipes]
+    else:
+        crafts = [(None, tuple(0 for _ in rules))]
+
+    empty = tuple(0 for _ in rules)
+    def standalone_points(contrib):
+        return sum(rule_points(pos, neg, v, v) for (pos, neg), v in zip(rules, contrib))
+    baseline = standalone_points(empty)
+
+    # Try the groups with the most promising affixes first to find a good incumbent early
+    groups.sort(key=lambda g: max(standalone_points(c) for _, c in g[1]) - baseline, reverse=True)
+    for kind, options in groups:
+        options.sort(key=lambda o: standalone_points(o[1]), reverse=True)
+    Ngroups = len(groups)
+
+    # Number of prefix/suffix groups left at each depth of the search
+    remaining_prefixes = [sum(1 for kind, _ in groups[d:] if kind == 'prefixes') for d in range(Ngroups+1)]
+    remaining_suffixes = [sum(1 for kind, _ in groups[d:] if kind == 'suffixes') for d in range(Ngroups+1)]
+
+    # Optimistic stat values reachable with the remaining groups.
+    # highest[d][r][k] is the sum of the k largest contributions to rule r among groups[d:], with one affix per group.
+    # lowest[d][r][k] is the same for the smallest contributions (matters for negative thresholds).
+    def running_sums(values):
+        sums = [0]
+        for v in values[:slots]:
+            sums.append(sums[-1] + v)
+        while len(sums) <= slots:
+            sums.append(sums[-1])
+        return sums
+
+    # Built from the last group back, keeping only the slots largest (smallest) contributions seen so far
+    highest = [None for _ in range(Ngroups+1)]
+    lowest = [None for _ in range(Ngroups+1)]
+    active = [None for _ in range(Ngroups+1)] # Rules that the remaining groups can still change
+    largest = [[] for _ in rules] # Negated, so that they sort largest first
+    smallest = [[] for _ in rules]
+    for d in range(Ngroups, -1, -1):
+        if d < Ngroups:
+            _, options = groups[d]
+            contribs = [c for _, c in options]
+            for r, column in enumerate(zip(*contribs)):
+                insort(largest[r], -max(column))
+                del largest[r][slots:]
+                insort(smallest[r], min(column))
+                del smallest[r][slots:]
+        highest[d] = [running_sums([-v for v in values]) for values in largest]
+        lowest[d] = [running_sums(values) for values in smallest]
+        active[d] = [r for r in range(len(rules)) if any(largest[r]) or any(smallest[r])]
+
+    best = None
+    effort = 0
+    incumbent = -1
+    if start is not None and start[1] is not None:
+        incumbent = start[0] - table.constant_points
+        best = tuple(sorted(start[1]))
+    nodes = 0
+    chosen = []
+    values = []
+    points = []
+
+    def bound(d, k, total):
+        # Admissible upper bound on the points of any completion of the current item
+        for r in active[d]:
+            pos, neg = rules[r]
+            total += (rule_points(pos, neg, values[r] + lowest[d][r][k], values[r] + highest[d][r][k])
+                      - points[r])
+        return total
+
+    def search(d, Np, Ns, total):
+        nonlocal incumbent, best, effort, nodes
+        nodes += 1
+        if deadline is not None and nodes % 64 == 0 and time.monotonic() > deadline:
+            raise SearchTimeout()
+        k = slots - Np - Ns
+        if k == 0:
+            effort += 1
+            if total > incumbent:
+                incumbent = total
+                best = tuple(sorted(chosen))
+            return
+        if d == Ngroups:
+            return
+        # Is it still possible to fill all slots with the remaining groups?
+        if (max(0, NP-Np) > remaining_prefixes[d] or
+            max(0, NS-Ns) > remaining_suffixes[d] or
+            (min(remaining_prefixes[d], NP+NA-Np) + min(remaining_suffixes[d], NS+NA-Ns) < k)):
+            return
+        if bound(d, k, total) <= incumbent:
+            return
+
+        kind, options = groups[d]
+        if ((kind == 'prefixes' and Np < NP+NA) or
+            (kind == 'suffixes' and Ns < NS+NA)):
+            for row, contrib in options:
+                # Take this affix
+                delta = 0
+                changed = []
+                for r, c in enumerate(contrib):
+                    if c:
+                        pos, neg = rules[r]
+                        old = points[r]
+                        # Keep the old value to restore it exactly (subtracting floats again would drift)
+                        changed.append((r, values[r], old))
+                        values[r] += c
+                        points[r] = rule_points(pos, neg, values[r], values[r])
+                        delta += points[r] - old
+                chosen.append(row)
+                if kind == 'prefixes':
+                    search(d+1, Np+1, Ns, total+delta)
+                else:
+                    search(d+1, Np, Ns+1, total+delta)
+                chosen.pop()
+                for r, value, old in changed:
+                    values[r] = value
+                    points[r] = old
+        # Skip this group
+        search(d+1, Np, Ns, total)
+
+    unfinished = -1 # Most points the recipes that weren't searched to the end could reach
+    crafts.sort(key=lambda c: standalone_points(c[1]), reverse=True)
+    for n, (recipe, contrib) in enumerate(crafts):
+        values = list(contrib)
+        points = [rule_points(pos, neg, v, v) for (pos, neg), v in zip(rules, values)]
+        chosen = [] if recipe is None else [recipe]
+        try:
+            search(0, 0, 0, sum(points))
+        except SearchTimeout:
+            for recipe, contrib in crafts[n:]:
+                values = list(contrib)
+                points = [rule_points(pos, neg, v, v) for (pos, neg), v in zip(rules, values)]
+                unfinished = max(unfinished, bound(0, slots, sum(points)))
+            break
+
+    upper_bound = max(incumbent, unfinished)
+    if best is None:
+        return 0, None, effort, max(0, upper_bound + table.constant_points)
+    return incumbent + table.constant_points, best, effort, upper_bound + table.constant_points
+
+def greedy_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Quick, but not necessarily maximal, points of an item built greedily (for each craft recipe):
+    the affix slots are filled one at a time with the affix that adds the most points,
+    then single affixes are swapped for better ones while that improves the item.
+    Returns (points, table rows of the item, effort) like the max points methods.
+    """
+    slots = NP + NS + NA
+    groups = table.prefix_groups + table.suffix_groups
+    Nprefix_groups = len(table.prefix_groups)
+    group_of = {row: g for g, group in enumerate(groups) for row in group}
+
+    def feasible(used):
+        # Can the affixes of these groups still be completed into an item?
+        Np = sum(1 for g in used if g < Nprefix_groups)
+        Ns = len(used) - Np
+        return (Np <= NP + NA and Ns <= NS + NA and
+                max(0, NP - Np) + max(0, NS - Ns) <= slots - len(used))
+
+    def best_addition(values, used):
+        # Highest scoring affix to add to an item, from any group that keeps it feasible -> (points, row)
+        rows = [row for g, group in enumerate(groups) if g not in used and feasible(used + [g]) for row in group]
+        if not rows:
+            return -1, None
+        points = score_values(table, values + table.rule_values[rows])
+        k = int(np.argmax(points))
+        return int(points[k]), rows[k]
+
+    max_points = -1
+    best = None
+    effort = 0
+    for recipe in (table.recipes if include_crafts else [None]):
+        chosen = [] if recipe is None else [recipe]
+        values = np.zeros((1, table.rule_values.shape[1]), dtype=table.rule_values.dtype)
+        if recipe is not None:
+            values = values + table.rule_values[recipe]
+        affixes = [] # Chosen prefix/suffix rows
+        points = int(score_values(table, values)[0])
+        for _ in range(slots):
+            points, row = best_addition(values, [group_of[a] for a in affixes])
+            effort += 1
+            if row is None:
+                break
+            affixes.append(row)
+            values = values + table.rule_values[row]
+        if len(affixes) < slots:
+            continue # Not enough groups for any item with this recipe
+
+        # Swap single affixes while that improves the item
+        improved = True
+        while improved:
+            improved = False
+            for j, row in enumerate(affixes):
+                others = affixes[:j] + affixes[j+1:]
+                rest = values - table.rule_values[row]
+                swap_points, swap_row = best_addition(rest, [group_of[a] for a in others])
+                effort += 1
+                if swap_points > points:
+                    affixes[j] = swap_row
+                    values = rest + table.rule_values[swap_row]
+                    points = swap_points
+                    improved = True
+
+        if points > max_points:
+            max_points = points
+            best = tuple(sorted(chosen + affixes))
+    if best is None:
+        return 0, None, effort
+    return max_points, best, effort
+
+def local_search_max_points(table, NP, NS, NA, include_crafts, seed=0, iterations=1500, restarts=2):
+    """
+    Heuristic, not necessarily maximal, points found by simulated annealing over the affixes of an item.
+    Every restart begins with a random item, then repeatedly swaps one affix for another affix of the same
+    or an unused group (or the craft recipe for another recipe), keeping worse items less and less often.
+    Items always follow the group and slot rules of iter_affixes, and the result is deterministic for a given seed.
+    """
+    rng = random.Random(seed)
+    slots = NP + NS + NA
+    groups = table.prefix_groups + table.suffix_groups
+    Nprefix_groups = len(table.prefix_groups)
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+    # Nonzero (rule, value) contributions of every table row
+    contributions = [[(r, c) for r, c in enumerate(row) if c] for row in table.rule_values.tolist()]
+    recipes = list(table.recipes) if include_crafts else [None]
+    prefix_ids = list(range(Nprefix_groups))
+    suffix_ids = list(range(Nprefix_groups, len(groups)))
+    if not recipes or len(prefix_ids) < NP or len(suffix_ids) < NS or len(groups) < slots:
+        return 0, None, 0
+
+    def is_prefix(g):
+        return g < Nprefix_groups
+
+    values = [0 for _ in rules]
+    points = [rule_points(pos, neg, 0, 0) for pos, neg in rules]
+    total = sum(points)
+
+    def add(row, sign):
+        # Add (or with sign -1, remove) a row's stats, returning the change in points
+        nonlocal total
+        if row is None:
+            return 0
+        delta = 0
+        for r, c in contributions[row]:
+            pos, neg = rules[r]
+            values[r] += sign * c
+            new = rule_points(pos, neg, values[r], values[r])
+            delta += new - points[r]
+            points[r] = new
+        total += delta
+        return delta
+
+    max_points = -1
+    best = None
+    effort = 0
+    for _ in range(restarts):
+        # Random item: NP prefix groups, NS suffix groups, and NA more from either side
+        chosen_groups = rng.sample(prefix_ids, NP) + rng.sample(suffix_ids, NS)
+        chosen_groups += rng.sample([g for g in range(len(groups)) if g not in chosen_groups], NA)
+        chosen = [rng.choice(groups[g]) for g in chosen_groups]
+        recipe = rng.choice(recipes)
+        for row in chosen + [recipe]:
+            add(row, 1)
+        Nprefixes = sum(1 for g in chosen_groups if is_prefix(g))
+
+        for step in range(iterations):
+            temperature = 2.0 * (0.02 / 2.0)**(step / iterations)
+            effort += 1
+            if include_crafts and rng.randrange(slots + 1) == slots:
+                # Another craft recipe
+                new_recipe = rng.choice(recipes)
+                delta = add(recipe, -1) + add(new_recipe, 1)
+                if delta >= 0 or rng.random() < exp(delta / temperature):
+                    recipe = new_recipe
+                else:
+                    add(new_recipe, -1)
+                    add(recipe, 1)
+            else:
+                # Another affix for one of the slots, from the same group or an unused one
+                j = rng.randrange(slots)
+                g = chosen_groups[j] if rng.random() < 0.5 else rng.randrange(len(groups))
+                if g != chosen_groups[j]:
+                    if g in chosen_groups:
+                        continue
+                    Np = Nprefixes - is_prefix(chosen_groups[j]) + is_prefix(g)
+                    if not (NP <= Np <= NP + NA and NS <= slots - Np <= NS + NA):
+                        continue
+                row = rng.choice(groups[g])
+                delta = add(chosen[j], -1) + add(row, 1)
+                if delta >= 0 or rng.random() < exp(delta / temperature):
+                    Nprefixes += is_prefix(g) - is_prefix(chosen_groups[j])
+                    chosen[j] = row
+                    chosen_groups[j] = g
+                else:
+                    add(row, -1)
+                    add(chosen[j], 1)
+            if total > max_points:
+                max_points = total
+                best = tuple(sorted(chosen + ([] if recipe is None else [recipe])))
+
+        for row in chosen + [recipe]:
+            add(row, -1)
+
+    # Score the best item from scratch, as float stats may have drifted while adding and removing them
+    return int(score_block(table, np.array([best], dtype=np.intp))[0]), best, effort
+
+def anytime_max_points(table, NP, NS, NA, include_crafts, budget):
+    """
+    Best points found within about budget seconds, and a proven upper bound on the maximum.
+    Starts from a greedy item (greedy_max_points) and improves it with branch and bound until the budget runs out.
+    Returns (max points, best rows, effort, upper bound); the points are proven maximal when they equal the bound.
+    """
+    deadline = time.monotonic() + budget
+    points, rows, effort = greedy_max_points(table, NP, NS, NA, include_crafts)
+    max_points, best, search_effort, upper_bound = branch_and_bound_search(table, NP, NS, NA, include_crafts,
+                                                                            start=(points, rows), deadline=deadline)
+    return max_points, best, effort + search_effort, upper_bound
+
+def maxsat_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Exact maximum points as a weighted MaxSAT problem, solved with RC2.
+    Hard clauses encode which affixes can roll together,
+    and every point threshold is a soft clause weighted by the points it awards.
+    """
+    # Pseudo-boolean encodings need pypblib, which is only required for this method
+    from pysat.formula import WCNF, IDPool
+    from pysat.card import CardEnc
+    from pysat.pb import PBEnc
+    from pysat.examples.rc2 import RC2
+
+    slots = NP + NS + NA
+    prefix_groups = table.prefix_groups
+    suffix_groups = table.suffix_groups
+    recipes = table.recipes if include_crafts else []
+    # Brute force finds no items at all when there aren't enough groups to roll from
+    if ((len(prefix_groups) < NP) or
+        (len(suffix_groups) < NS) or
+        (len(prefix_groups) + len(suffix_groups) < slots) or
+        (include_crafts and not recipes)):
+        return 0, None, 0
+
+    pool = IDPool()
+    wcnf = WCNF()
+    row_vars = {} # variable -> table row (affix or craft recipe)
+
+    # Each group rolls at most one affix, and is used if any of its affixes roll
+    prefix_used = []
+    suffix_used = []
+    for kind, groups, used in (('prefixes', prefix_groups, prefix_used), ('suffixes', suffix_groups, suffix_used)):
+        for g, group in enumerate(groups):
+            xs = []
+            for row in group:
+                x = pool.id(('row', row))
+                row_vars[x] = row
+                xs.append(x)
+            u = pool.id((kind, g))
+            used.append(u)
+            wcnf.extend(CardEnc.atmost(xs, 1, vpool=pool).clauses)
+            wcnf.append([-u] + xs)
+            wcnf.extend([[-x, u] for x in xs])
+    # At least NP prefixes, NS suffixes, and NA more random affixes from either side
+    wcnf.extend(CardEnc.atleast(prefix_used, NP, vpool=pool).clauses)
+    wcnf.extend(CardEnc.atleast(suffix_used, NS, vpool=pool).clauses)
+    wcnf.extend(CardEnc.equals(prefix_used + suffix_used, slots, vpool=pool).clauses)
+    # Exactly one craft recipe (all of its mods apply)
+    recipe_vars = []
+    for row in recipes:
+        c = pool.id(('row', row))
+        row_vars[c] = row
+        recipe_vars.append(c)
+    if recipe_vars:
+        wcnf.extend(CardEnc.equals(recipe_vars, 1, vpool=pool).clauses)
+
+    # Stats can be fractional, but PB constraints need integer weights
+    scale = 1
+    for v in np.unique(table.rule_values).tolist():
+        scale = lcm(scale, Fraction(v).limit_denominator(1000).denominator)
+
+    free_points = table.constant_points # Points awarded no matter which affixes roll
+    for r, (positive, negative) in enumerate(zip(table.positive, table.negative)):
+        lits = []
+        weights = []
+        for v, row in row_vars.items():
+            w = round(table.rule_values[row, r]*scale)
+            if w:
+                lits.append(v)
+                weights.append(w)
+        lowest = sum(w for w in weights if w < 0)
+        highest = sum(w for w in weights if w > 0)
+
+        # Positive thresholds: a point for each stat > threshold
+        # Negative thresholds: a point for each stat < abs(threshold)
+        indicators = []
+        for threshold, multiplicity in sorted(Counter(positive.tolist()).items()):
+            bound = round(threshold*scale) + 1
+            if bound <= lowest:
+                free_points += multiplicity
+            elif bound <= highest:
+                z = pool.id(('point', r, threshold))
+                encoding = PBEnc.atleast(lits, weights, bound, vpool=pool)
+                wcnf.extend([[-z] + cl for cl in encoding.clauses])
+                wcnf.append([z], weight=multiplicity)
+                # Higher thresholds imply the lower ones
+                if indicators:
+                    wcnf.append([-z, indicators[-1]])
+                indicators.append(z)
+        indicators = []
+        for threshold, multiplicity in sorted(Counter(negative.tolist()).items(), reverse=True):
+            bound = round(threshold*scale) - 1
+            if bound >= highest:
+                free_points += multiplicity
+            elif bound >= lowest:
+                z = pool.id(('point', r, -threshold))
+                encoding = PBEnc.atmost(lits, weights, bound, vpool=pool)
+                wcnf.extend([[-z] + cl for cl in encoding.clauses])
+                wcnf.append([z], weight=multiplicity)
+                if indicators:
+                    wcnf.append([-z, indicators[-1]])
+                indicators.append(z)
+
+    with RC2(wcnf) as rc2:
+        model = rc2.compute()
+        if model is None:
+            return 0, None, 0
+        max_points = free_points + sum(wcnf.wght) - rc2.cost
+
+    best = tuple(sorted(row_vars[v] for v in model if v > 0 and v in row_vars))
+    points = int(score_block(table, np.array([best], dtype=np.intp))[0])
+    assert (points == max_points), f"MaxSAT optimum ({max_points}) disagrees with the points of its solution ({points})"
+    return max_points, best, 1
+
+def vectorized_max_points(table, NP, NS, NA, include_crafts, shard=None, block_bytes=BLOCK_BYTES):
+    """
+    Same exhaustive search as brute force, but scoring blocks of thousands of items
+    at once with numpy instead of calling calculate_points on every item.
+    Blocks are sized to keep their index and stat arrays within about block_bytes.
+    """
+    # Each item of a block is a row of table indices, and while scoring
+    # its summed point rule values (plus a temporary copy) and its points
+    width = NP + NS + NA + (1 if include_crafts else 0)
+    item_bytes = (width*np.dtype(np.intp).itemsize +
+                  2*table.rule_values.shape[1]*table.rule_values.itemsize +
+                  np.dtype(np.int64).itemsize)
+    block_size = max(1, block_bytes // item_bytes)
+    max_points = 0
+    best = None
+    effort = 0
+    for idx in iter_affix_indices(NP, NS, NA, include_crafts, table, shard, block_size):
+        points = score_block(table, idx)
+        effort += len(idx)
+        i = points.argmax()
+        if best is None or points[i] > max_points:
+            max_points = int(points[i])
+            best = tuple(sorted(idx[i].tolist()))
+    return max_points, best, effort
+
+def cluster_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Exact maximum points by splitting the problem into independent stat clusters.
+    Groups that add to the same point rule (directly, or through other groups) form a cluster.
+    Every cluster is searched exhaustively on its own, for every number of prefix and suffix groups it could use,
+    and a small DP over the shared affix slots combines the clusters.
+    The effort then grows with the largest cluster instead of with the product of all of them.
+    """
+    slots = NP + NS + NA
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+    contributions = [tuple(c) for c in table.rule_values.tolist()]
+    clusters = stat_clusters(table)
+
+    if include_crafts:
+        # Craft recipes always add all of their mods, so each one is just a different starting point
+        crafts = [(row, contributions[row]) for row in table.recipes]
+    else:
+        crafts = [(None, tuple(0 for _ in rules))]
+    # Rules that no group adds to only depend on the craft recipe
+    clustered_rules = {r for cluster_rules, _ in clusters for r in cluster_rules}
+    unclustered_rules = [r for r in range(len(rules)) if r not in clustered_rules]
+
+    effort = 0
+    memo = [{} for _ in clusters]
+    def solve_cluster(c, start):
+        # Best (points, rows) of the cluster for every (prefix groups, suffix groups) it could use
+        nonlocal effort
+        cluster_rules, groups = clusters[c]
+        key = tuple(start[r] for r in cluster_rules)
+        if key in memo[c]:
+            return memo[c][key]
+        best = {}
+        for n in range(min(len(groups), slots) + 1):
+            for chosen in combinations(groups, n):
+                Np = sum(1 for kind, _ in chosen if kind == 'prefixes')
+                Ns = n - Np
+                if Np > NP + NA or Ns > NS + NA:
+                    continue
+                for rows in product(*(group for _, group in chosen)):
+                    effort += 1
+                    points = 0
+                    for r in cluster_rules:
+                        pos, neg = rules[r]
+                        value = start[r] + sum(contributions[row][r] for row in rows)
+                        points += rule_points(pos, neg, value, value)
+                    if (Np, Ns) not in best or points > best[(Np, Ns)][0]:
+                        best[(Np, Ns)] = (points, rows)
+        memo[c][key] = best
+        return best
+
+    max_points = -1
+    best = None
+    for recipe, start in crafts:
+        combined = combine_clusters([solve_cluster(c, start) for c in range(len(clusters))], NP, NS, NA)
+        if combined is None:
+            continue
+        points, rows = combined
+        points += sum(rule_points(*rules[r], start[r], start[r]) for r in unclustered_rules)
+        if points > max_points:
+            max_points = points
+            best = tuple(sorted(rows if recipe is None else rows + (recipe,)))
+
+    if best is None:
+        return 0, None, effort
+    return max_points + table.constant_points, best, effort
+
+def combine_clusters(cluster_options, NP, NS, NA):
+    """
+    Best item made of one option from every cluster, by a small DP over the shared affix slots.
+    cluster_options has a {(prefix groups, suffix groups): (points, rows)} dict for every cluster.
+    Returns the (points, rows) of the best item that fills the slots exactly, or None if no item does.
+    """
+    slots = NP + NS + NA
+    # (prefix groups, suffix groups) used so far -> best (points, rows)
+    states = {(0, 0): (0, ())}
+    for options in cluster_options:
+        new_states = {}
+        for (Np, Ns), (points, rows) in states.items():
+            for (np_, ns), (cluster_points, cluster_rows) in options.items():
+                state = (Np + np_, Ns + ns)
+                if state[0] > NP + NA or state[1] > NS + NA or sum(state) > slots:
+                    continue
+                total = points + cluster_points
+                if state not in new_states or total > new_states[state][0]:
+                    new_states[state] = (total, rows + cluster_rows)
+        states = new_states
+    best = None
+    for (Np, Ns), (points, rows) in states.items():
+        if Np >= NP and Ns >= NS and Np + Ns == slots and (best is None or points > best[0]):
+            best = (points, rows)
+    return best
+
+def bucket_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Exact maximum points by dynamic programming over the groups, one group at a time.
+    A DP state is the number of prefix and suffix groups used so far plus the stat totals of the point rules
+    that later groups can still change; every other rule has already been turned into points.
+    Totals are capped where no higher total could score differently,
+    and states that agree on everything else only keep their highest points.
+    """
+    slots = NP + NS + NA
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+    contributions = [tuple(c) for c in table.rule_values.tolist()]
+
+    # Visit the groups one stat cluster at a time, so that rules are settled as early as possible
+    groups = [group for _, cluster_groups in stat_clusters(table) for group in cluster_groups]
+    Ngroups = len(groups)
+    remaining_prefixes = [sum(1 for kind, _ in groups[d:] if kind == 'prefixes') for d in range(Ngroups+1)]
+    remaining_suffixes = [sum(1 for kind, _ in groups[d:] if kind == 'suffixes') for d in range(Ngroups+1)]
+
+    # Rules that groups[d:] can change ("live" rules), and those that become settled after groups[d]
+    last_group = {}
+    for d, (_, group) in enumerate(groups):
+        for r in np.flatnonzero(table.rule_values[group].any(axis=0)).tolist():
+            last_group[r] = d
+    live = [sorted(r for r, last in last_group.items() if last >= d) for d in range(Ngroups+1)]
+
+    # Any total of at least cap[r] scores the same, now and after adding more (non-negative) values
+    caps = []
+    for r, (pos, neg) in enumerate(rules):
+        if table.rule_values[:, r].min(initial=0) < 0:
+            caps.append(None)
+        else:
+            caps.append(max(pos[-1] + 1 if pos else 0, neg[-1] if neg else 0))
+    def capped(r, value):
+        if caps[r] is not None and value > caps[r]:
+            return caps[r]
+        return value
+
+    if include_crafts:
+        # Craft recipes always add all of their mods
+        crafts = [(row, contributions[row]) for row in table.recipes]
+    else:
+        crafts = [(None, tuple(0 for _ in rules))]
+
+    effort = 0
+    max_points = -1
+    best = None
+    for recipe, start in crafts:
+        # (prefix groups, suffix groups, totals of the live rules) -> (points of settled rules, rows)
+        settled = sum(rule_points(*rules[r], start[r], start[r]) for r in range(len(rules)) if r not in last_group)
+        states = {(0, 0, tuple(capped(r, start[r]) for r in live[0])): (settled, ())}
+        for d, (kind, group) in enumerate(groups):
+            index = {r: i for i, r in enumerate(live[d])}
+            live_after = set(live[d+1])
+            new_states = {}
+            def add(Np, Ns, totals, points, rows):
+                # Feasible states keep the totals of the rules still live after this group, and score the rest
+                if (Np + Ns > slots or Np > NP + NA or Ns > NS + NA or
+                    NP - Np > remaining_prefixes[d+1] or NS - Ns > remaining_suffixes[d+1] or
+                    slots - Np - Ns > remaining_prefixes[d+1] + remaining_suffixes[d+1]):
+                    return
+                for r in live[d]:
+                    if r not in live_after:
+                        value = totals[index[r]]
+                        points += rule_points(*rules[r], value, value)
+                key = (Np, Ns, tuple(totals[index[r]] for r in live[d+1]))
+                if key not in new_states or points > new_states[key][0]:
+                    new_states[key] = (points, rows)
+            for (Np, Ns, totals), (points, rows) in states.items():
+                effort += 1
+                # Skip this group
+                add(Np, Ns, totals, points, rows)
+                # Or take one of its affixes
+                for row in group:
+                    effort += 1
+                    new_totals = tuple(capped(r, t + contributions[row][r]) for r, t in zip(live[d], totals))
+                    if kind == 'prefixes':
+                        add(Np+1, Ns, new_totals, points, rows + (row,))
+                    else:
+                        add(Np, Ns+1, new_totals, points, rows + (row,))
+            states = new_states
+        for (Np, Ns, _), (points, rows) in states.items():
+            if Np >= NP and Ns >= NS and Np + Ns == slots and points > max_points:
+                max_points = points
+                best = tuple(sorted(rows if recipe is None else rows + (recipe,)))
+
+    if best is None:
+        return 0, None, effort
+    return max_points + table.constant_points, best, effort
+
+def frontier_max_points(table, NP, NS, NA, include_crafts):
+    """
+    Exact maximum points from the stat frontier of the problem (see stat_frontier).
+    The frontier is computed here unless solve_max_points attached one (from an earlier build) to the table.
+    Every frontier point is scored with the current thresholds, and the clusters are combined
+    with the same DP over the affix slots as cluster_max_points (combine_clusters).
+    """
+    frontier = getattr(table, 'frontier', None)
+    if frontier is None:
+        frontier = stat_frontier(table, NP, NS, NA)
+    rules = [(pos.tolist(), neg.tolist()) for pos, neg in zip(table.positive, table.negative)]
+
+    # Point rules of each cluster, as (rule, [(position in the cluster's stats, weight), ...])
+    cluster_of = {}
+    for c, cluster in enumerate(frontier['clusters']):
+        for i, stat in enumerate(cluster['stats']):
+            cluster_of[stat] = (c, i)
+    cluster_rules = [[] for _ in frontier['clusters']]
+    for r, column in enumerate(table.active):
+        stat_ids = np.flatnonzero(table.weights[:, column]).tolist()
+        c = cluster_of[stat_ids[0]][0]
+        cluster_rules[c].append((r, [(cluster_of[s][1], int(table.weights[s, column])) for s in stat_ids]))
+
+    if include_crafts:
+        crafts = [(row, table.matrix[row].tolist()) for row in table.recipes]
+    else:
+        crafts = [(None, [0 for _ in table.stats])]
+
+    effort = 0
+    max_points = -1
+    best = None
+    for recipe, start in crafts:
+        cluster_options = []
+        for cluster, point_rules in zip(frontier['clusters'], cluster_rules):
+            offset = [start[s] for s in cluster['stats']]
+            # Best frontier point of the cluster for every number of prefix and suffix groups
+            options = {}
+            for Np, Ns, vectors in cluster['options']:
+                for vector, rows in vectors:
+                    effort += 1
+                    points = 0
+                    for r, terms in point_rules:
+                        value = sum(weight*(vector[i] + offset[i]) for i, weight in terms)
+                        points += rule_points(*rules[r], value, value)
+                    if (Np, Ns) not in options or points > options[(Np, Ns)][0]:
+                        options[(Np, Ns)] = (points, tuple(rows))
+            cluster_options.append(options)
+        combined = combine_clusters(cluster_options, NP, NS, NA)
+        if combined is not None and combined[0] > max_points:
+            max_points, rows = combined
+            best = tuple(sorted(rows if recipe is None else rows + (recipe,)))
+
+    if best is None:
+        return 0, None, effort
+    return max_points + table.constant_points, best, effort
+
+def stat_frontier(table, NP, NS, NA):
+    """
+    Pareto frontier of the stat totals that the affixes of a problem can reach, in JSON friendly form.
+    Stats that share an affix group or a point rule form a cluster, and for every cluster and every
+    number of prefix and suffix groups it could use, only the undominated stat totals are kept
+    (with the table rows that reach them).
+    The frontier doesn't depend on the thresholds, only on which way they point for each stat,
+    so it can score new thresholds without searching the affixes again.
+    """
+    slots = NP + NS + NA
+    directions = stat_directions(table)
+    Nstats = len(table.stats)
+    groups = [('prefixes', group) for group in table.prefix_groups] + [('suffixes', group) for group in table.suffix_groups]
+    group_stats = [np.flatnonzero(table.matrix[group].any(axis=0)).tolist() for _, group in groups]
+    rule_stats = [np.flatnonzero(table.weights[:, column]).tolist() for column in table.active]
+    root = connected_components(Nstats, group_stats + rule_stats)
+
+    clusters = {}
+    for s in range(Nstats):
+        clusters.setdefault(root[s], ([], []))[0].append(s)
+    fillers = []
+    for (kind, group), stat_ids in zip(groups, group_stats):
+        if stat_ids:
+            clusters[root[stat_ids[0]]][1].append((kind, group))
+        else:
+            fillers.append(([], [(kind, group)]))
+
+    frontier = []
+    for stat_ids, cluster_groups in list(clusters.values()) + fillers:
+        values = {row: table.matrix[row, stat_ids].tolist() for _, group in cluster_groups for row in group}
+        # Bigger is better in every column of the key: stats scored both ways get two columns
+        def key(vector):
+            k = []
+            for s, v in zip(stat_ids, vector):
+                if 1 in directions[s]:
+                    k.append(v)
+                if -1 in directions[s]:
+                    k.append(-v)
+            return k
+
+        reachable = {} # (prefix groups, suffix groups) -> {stat totals: rows}
+        for n in range(min(len(cluster_groups), slots) + 1):
+            for chosen in combinations(cluster_groups, n):
+                Np = sum(1 for kind, _ in chosen if kind == 'prefixes')
+                Ns = n - Np
+                if Np > NP + NA or Ns > NS + NA:
+                    continue
+                vectors = reachable.setdefault((Np, Ns), {})
+                for rows in product(*(group for _, group in chosen)):
+                    vector = tuple(sum(values[row][i] for row in rows) for i in range(len(stat_ids)))
+                    vectors.setdefault(vector, list(rows))
+
+        options = []
+        for (Np, Ns), vectors in reachable.items():
+            # Any dominating vector has at least the same key sum, so it is already kept when its dominees come up
+            kept = []
+            for vector, rows in sorted(vectors.items(), key=lambda v: sum(key(v[0])), reverse=True):
+                k = key(vector)
+                if not any(all(a >= b for a, b in zip(other, k)) for other, _, _ in kept):
+                    kept.append((k, vector, rows))
+            options.append([Np, Ns, [[list(vector), rows] for _, vector, rows in kept]])
+        frontier.append({'stats': stat_ids, 'options': options})
+    return {'clusters': frontier}
+
+def stat_directions(table):
+    """For every stat of a scoring table: 1 if higher totals can score more points, -1 if lower totals can (or both)."""
+    directions = [set() for _ in table.stats]
+    for r, column in enumerate(table.active):
+        for s in np.flatnonzero(table.weights[:, column]).tolist():
+            directions[s] |= rule_directions(table.positive[r], table.negative[r])
+    return directions
+
+def frontier_signature(problem):
+    """Hash of everything the stat frontier of a problem depends on, which leaves out the thresholds themselves."""
+    table = problem.table
+    digest = hashlib.sha256(repr((problem.slots,
+                                  table.prefix_groups,
+                                  table.suffix_groups,
+                                  table.recipes,
+                                  [sorted(d) for d in stat_directions(table)],
+                                  table.matrix.dtype.str,
+                                  table.matrix.shape)).encode())
+    digest.update(table.matrix.tobytes())
+    digest.update(np.ascontiguousarray(table.weights[:, table.active]).tobytes())
+    return digest.hexdigest()
+
+def attach_frontiers(problems, cache_file=None, used=(), verbose=False):
+    """
+    Attach the stat frontier of every problem to its table, reusing and updating the frontiers in cache_file.
+    Only the frontiers of these problems and of the used problems (e.g. those with cached results) stay in the cache.
+    """
+    cache = {} if cache_file is None else read_json_cache(cache_file, {})
+    kept = {}
+    for problem in used:
+        signature = frontier_signature(problem)
+        if signature in cache:
+            kept[signature] = cache[signature]
+    Ncomputed = 0
+    for problem in problems:
+        signature = frontier_signature(problem)
+        if signature not in kept:
+            if signature in cache:
+                kept[signature] = cache[signature]
+            else:
+                NP, NS, NA, _ = problem.slots
+                kept[signature] = stat_frontier(problem.table, NP, NS, NA)
+                Ncomputed += 1
+        problem.table.frontier = kept[signature]
+    if verbose:
+        print(f'Computed {Ncomputed} stat frontiers, reused {len(problems) - Ncomputed}')
+    if cache_file is not None and kept != cache:
+        write_json_cache(cache_file, kept)
+
+def meet_in_the_middle_max_points(table, NP, NS, NA, include_crafts, block_size=8192):
+    """
+    Exact maximum points by combining prefix-side and suffix-side partial items.
+    Each side is enumerated on its own (for every number of affixes it could take), reduced to its distinct,
+    undominated point rule totals, and then every prefix side is paired with all suffix sides at once.
+    Prefix sides are tried from the highest optimistic bound down, stopping when none can beat the best item.
+    """
+    slots = NP + NS + NA
+    Nrules = table.rule_values.shape[1]
+    # Higher totals are better for rules with positive thresholds, lower for negative thresholds
+    directions = [rule_directions(pos, neg) for pos, neg in zip(table.positive, table.negative)]
+    up = [r for r in range(Nrules) if 1 in directions[r]]
+    down = [r for r in range(Nrules) if -1 in directions[r]]
+
+    def side(groups, n):
+        """Distinct undominated (totals, rows) of all ways to take one affix from each of n distinct groups."""
+        rows = [picks for chosen in combinations(groups, n) for picks in product(*chosen)]
+        if not rows:
+            return np.zeros((0, Nrules), dtype=table.rule_values.dtype), []
+        idx = np.array(rows, dtype=np.intp).reshape(len(rows), n)
+        totals = table.rule_values[idx].sum(axis=1)
+        totals, first = np.unique(totals, axis=0, return_index=True)
+        # Bigger is better in every column of the key, so a dominating side has at least the same key sum
+        key = np.hstack([totals[:, up], -totals[:, down]])
+        order = np.argsort(-key.sum(axis=1), kind='stable')
+        kept = []
+        for i in order:
+            if kept and (key[kept] >= key[i]).all(axis=1).any():
+                continue
+            kept.append(i)
+        return totals[kept], [rows[first[i]] for i in kept]
+
+    if include_crafts:
+        crafts = [(row, table.rule_values[row]) for row in table.recipes]
+    else:
+        crafts = [(None, np.zeros(Nrules, dtype=table.rule_values.dtype))]
+
+    effort = 0
+    max_points = -1
+    best = None
+    for Nprefixes in range(NP, NP + NA + 1):
+        Nsuffixes = slots - Nprefixes
+        if Nsuffixes < NS:
+            continue
+        prefix_totals, prefix_rows = side(table.prefix_groups, Nprefixes)
+        suffix_totals, suffix_rows = side(table.suffix_groups, Nsuffixes)
+        if not len(prefix_totals) or not len(suffix_totals):
+            continue
+        suffix_low = suffix_totals.min(axis=0)
+        suffix_high = suffix_totals.max(axis=0)
+        # Pair as many prefix sides at a time as make a block of about block_size items
+        step = max(1, block_size // len(suffix_totals))
+        for recipe, start in crafts:
+            # Most points any suffix side could add to each prefix side
+            bounds = score_values(table, prefix_totals + suffix_low + start, prefix_totals + suffix_high + start)
+            order = np.argsort(-bounds, kind='stable')
+            for i in range(0, len(order), step):
+                chunk = order[i:i+step]
+                chunk = chunk[bounds[chunk] > max_points]
+                if not len(chunk):
+                    break
+                totals = (prefix_totals[chunk][:, None, :] + suffix_totals[None, :, :]).reshape(len(chunk)*len(suffix_totals), Nrules)
+                points = score_values(table, totals + start)
+                effort += len(points)
+                k = points.argmax()
+                if points[k] > max_points:
+                    max_points = int(points[k])
+                    p, s = divmod(int(k), len(suffix_totals))
+                    rows = prefix_rows[chunk[p]] + suffix_rows[s]
+                    best = tuple(sorted(rows if recipe is None else rows + (recipe,)))
+
+    if best is None:
+        return 0, None, effort
+    return max_points, best, effort
+
+def stat_clusters(table):
+    """
+    Connected components of the groups and the point rules they add to.
+    Returns a list of (point rule columns, [(kind, group rows), ...]) for each cluster.
+    Groups that don't add to any point rule are clusters of their own.
+    """
+    Nrules = table.rule_values.shape[1]
+    groups = [('prefixes', group) for group in table.prefix_groups] + [('suffixes', group) for group in table.suffix_groups]
+    touched = [np.flatnonzero(table.rule_values[group].any(axis=0)).tolist() for _, group in groups]
+    root = connected_components(Nrules, touched)
+
+    clusters = {}
+    singles = []
+    for (kind, group), rule_ids in zip(groups, touched):
+        if rule_ids:
+            clusters.setdefault(root[rule_ids[0]], []).append((kind, group))
+        else:
+            singles.append(([], [(kind, group)]))
+    cluster_rules = {}
+    for r in range(Nrules):
+        cluster_rules.setdefault(root[r], []).append(r)
+    return [(cluster_rules[c], cluster_groups) for c, cluster_groups in clusters.items()] + singles
+
+def connected_components(size, links):
+    """
+    Union-find over the elements range(size): every list in links joins its elements into one component.
+    Returns the component (its root element) of every element.
+    """
+    parent = list(range(size))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for ids in links:
+        for i in ids[1:]:
+            parent[find(i)] = find(ids[0])
+    return [find(i) for i in range(size)]
+
+MAX_POINTS_METHODS = {'brute': brute_force_max_points,
+                      'bnb': branch_and_bound_max_points,
+                      'maxsat': maxsat_max_points,
+                      'vectorized': vectorized_max_points,
+                      'clusters': cluster_max_points,
+                      'buckets': bucket_max_points,
+                      'frontier': frontier_max_points,
+                      'incremental': incremental_max_points,
+                      'mitm': meet_in_the_middle_max_points,
+                      'local': local_search_max_points}
+# Exhaustive methods that can search a shard (slice of the prefix group combinations) of a problem
+SHARDABLE_METHODS = {'brute', 'vectorized', 'incremental'}
+# Methods that aren't guaranteed to find the maximum (their results are flagged, and never cached)
+HEURISTIC_METHODS = {'local'}
+
+def calculate_points(args):
+    affixes, point_rules = args
+    # Affixes and point rules are the records made by extract_stats_from_affixes,
+    # so stats are indices into the region's stat vectors.
+
+    # Sum the stat vectors of all affixes
+    totals = [sum(values) for values in zip(*(affix.values for affix in affixes))]
+    affix_names = [affix.name for affix in affixes]
+
     # Tally the number of points achieved by those stats
     points = 0
-    for point_rule in region_rules:
-        sum_stats = point_rule.fields['stat'].split('+')
-        achieved = sum([total_stats[stat] for stat in sum_stats if stat in total_stats])
-        # rule.fields['thresholds'] is sorted list of integer thresholds
+    for point_rule in point_rules:
+        # Stats can be repeated to count them more than once
+        achieved = sum(totals[stat] for stat in point_rule.stats) if totals else 0
+        # point_rule.thresholds is sorted tuple of integer thresholds
         # Use bisect_left because it tells you how many values the query is >
         # bisect_right (aka bisect) gives you >=
-        if all_positive(point_rule.fields['thresholds']):
-            points += bisect_left(point_rule.fields['thresholds'], achieved)
+        if point_rule.all_positive:
+            points += bisect_left(point_rule.thresholds, achieved)
         else:
             # Compute all negative or mixed points using O(N) tallying
-            for threshold in point_rule.fields['thresholds']:
+            for threshold in point_rule.thresholds:
                 if ((threshold >= 0) and (achieved > threshold)):
                     points += 1
                 elif ((threshold <0) and (achieved < abs(threshold))):
                     points += 1
                 else:
                     pass
-            
+
+    total_stats = {stat: value for stat, value in enumerate(totals) if value}
     return points, total_stats, affix_names
 
+def compile_point_rule(point_rule):
+    """Split a point rule into (summed stats, sorted positive thresholds, sorted absolute negative thresholds)."""
+    rule_stats = point_rule.stats
+    thresholds = point_rule.thresholds
+    positive = [t for t in thresholds if t >= 0]
+    negative = sorted(abs(t) for t in thresholds if t < 0)
+    return rule_stats, positive, negative
+
+def rule_directions(positive, negative):
+    """Which way a compiled point rule counts: 1 if higher totals can score more points, -1 if lower totals can (or both)."""
+    directions = set()
+    if len(positive):
+        directions.add(1)
+    if len(negative):
+        directions.add(-1)
+    return directions
+
+def rule_points(positive, negative, low, high):
+    """
+    Points awarded by a compiled point rule.
+    With low == high this is the exact number of points for that stat value,
+    otherwise it is the most points any value in [low, high] could award.
+    """
+    # Positive thresholds award points for values > threshold,
+    # negative thresholds for values < abs(threshold).
+    return bisect_left(positive, high) + len(negative) - bisect_right(negative, low)
+
+def compile_scoring_table(grouped_affixes, point_rules):
+    """
+    Dense numpy form of a region's affixes and point rules for score_block.
+    - rows/point_rules: the affixes summed into each row, and the point rules themselves
+    - matrix: one row per affix (or craft recipe), one column per point-relevant stat
+    - weights: how many times each stat column is counted by each point rule
+    - active: the point rules (columns of weights) that affixes can change
+    - rule_values: value each row adds to the (summed) stat of every point rule that affixes can change
+    - positive/negative: sorted threshold arrays of those point rules
+    - constant_points: points from the other rules, which are the same for every item
+    - prefix_groups/suffix_groups/recipes: matrix row indices, grouped like grouped_affixes
+    """
+    rules = [compile_point_rule(r) for r in point_rules]
+    stats = sorted({stat for rule_stats, _, _ in rules for stat in rule_stats})
+    rows = [] # Affixes summed into each row of the matrix
+
+    def add_row(affixes):
+        rows.append(affixes)
+        return len(rows) - 1
+
+    prefix_groups = [[add_row([affix]) for affix in group] for group in grouped_affixes['prefixes']]
+    suffix_groups = [[add_row([affix]) for affix in group] for group in grouped_affixes['suffixes']]
+    recipes = [add_row(list(recipe)) for recipe in grouped_affixes['crafts']]
+
+    values = [[sum(affix.values[stat] for affix in affixes) for stat in stats] for affixes in rows]
+    if any(isinstance(v, float) for row in values for v in row):
+        dtype = np.float64
+    else:
+        dtype = np.int64
+    matrix = np.array(values, dtype=dtype).reshape(len(rows), len(stats))
+
+    weights = np.zeros((len(stats), len(rules)), dtype=np.int64)
+    for r, (rule_stats, _, _) in enumerate(rules):
+        for stat in rule_stats:
+            weights[stats.index(stat), r] += 1
+
+    # Rules that no affix can change always award the same points
+    rule_values = matrix @ weights
+    active = [r for r in range(len(rules)) if rule_values[:, r].any()]
+    constant_points = sum(rule_points(pos, neg, 0, 0)
+                          for r, (_, pos, neg) in enumerate(rules) if r not in active)
+
+    return SimpleNamespace(stats=stats,
+                           rows=rows,
+                           point_rules=point_rules,
+                           matrix=matrix,
+                           weights=weights,
+                           active=active,
+                           rule_values=np.ascontiguousarray(rule_values[:, active]),
+                           constant_points=constant_points,
+                           positive=[np.array(rules[r][1], dtype=dtype) for r in active],
+                           negative=[np.array(rules[r][2], dtype=dtype) for r in active],
+                           prefix_groups=prefix_groups,
+                           suffix_groups=suffix_groups,
+                           recipes=recipes)
+
+def score_block(table, idx):
+    """Points for a block of items, given as a 2D array of scoring table row indices (one item per row)."""
+    # Sum the (precomputed) point rule values of each item's affixes, one column at a time
+    values = table.rule_values[idx[:, 0]]
+    for c in range(1, idx.shape[1]):
+        values += table.rule_values[idx[:, c]]
+    return score_values(table, values)
+
+def score_values(table, low, high=None):
+    """
+    Points for a 2D array of point rule totals (one item per row), including the constant points.
+    Like rule_points, given the low and high totals it is the most points any totals in between could award.
+    """
+    if high is None:
+        high = low
+    points = np.full(len(low), table.constant_points, dtype=np.int64)
+    for r, (positive, negative) in enumerate(zip(table.positive, table.negative)):
+        # Positive thresholds award points for values > threshold,
+        # negative thresholds for values < abs(threshold).
+        if len(positive):
+            points += np.searchsorted(positive, high[:, r], side='left')
+        if len(negative):
+            points += len(negative) - np.searchsorted(negative, low[:, r], side='right')
+    return points
+
 def all_positive(numbers):
     for number in numbers:
         if number < 0:
@@ -222,15 +1759,67 @@ def discard_worthless_affixes(regions, verbose=False):
 
     return regions
 
+@dataclass(frozen=True, slots=True, eq=False)
+class AffixRecord:
+    """
+    Compact, immutable form of an affix (or craft mod) Rule for the max points search.
+    values is the affix's stat vector over the stats interned by its region.
+    """
+    id: int
+    name: str
+    group: str
+    magic_only: bool
+    values: tuple
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name})'
+
+@dataclass(frozen=True, slots=True, eq=False)
+class PointRecord:
+    """
+    Compact, immutable form of a point Rule for the max points search.
+    stats are indices into the region's stat vectors (repeated to count a stat more than once).
+    """
+    stats: tuple
+    thresholds: tuple
+    all_positive: bool
+
 def extract_stats_from_affixes(regions):
     # Extracts stats from the rule and stores in easy to use form
     # This will save a bit of processing time which may add up
     # during the very many iterations of computing point values.
+    # The applicable Rules of each region are replaced by AffixRecords and PointRecords,
+    # with every stat of the region interned to an index (listed in region.stats).
     for region in regions:
         extract_stats(region.applicable_prefixes)
         extract_stats(region.applicable_suffixes)
         extract_stats(region.applicable_crafts)
 
+        affixes = region.applicable_prefixes + region.applicable_suffixes + region.applicable_crafts
+        stats = set()
+        for affix in affixes:
+            stats.update(affix.fields['stats'])
+        for point_rule in region.applicable_points:
+            stats.update(point_rule.fields['stat'].split('+'))
+        region.stats = sorted(stats)
+        stat_index = {stat: i for i, stat in enumerate(region.stats)}
+        group_index = {}
+
+        def affix_record(rule):
+            values = [0 for _ in region.stats]
+            for stat, value in rule.fields['stats'].items():
+                values[stat_index[stat]] = value
+            group = group_index.setdefault(rule.fields['group'], len(group_index))
+            return AffixRecord(rule.var, rule.fields['affix'], group, rule.fields['magic_only'], tuple(values))
+
+        region.applicable_prefixes = [affix_record(rule) for rule in region.applicable_prefixes]
+        region.applicable_suffixes = [affix_record(rule) for rule in region.applicable_suffixes]
+        region.applicable_crafts = [affix_record(rule) for rule in region.applicable_crafts]
+        region.applicable_points = [PointRecord(tuple(stat_index[stat] for stat in rule.fields['stat'].split('+')),
+                                                tuple(rule.fields['thresholds']),
+                                                all_positive(rule.fields['thresholds']))
+                                    for rule in region.applicable_points]
+
 def extract_stats(rules):
     for rule in rules:
         # Most affixes will just give a single stat,
@@ -273,6 +1862,60 @@ def convert_res(stats, vals):
             new_vals.append(val)
     return new_stats, new_vals
     
+def prune_dominated_affixes(grouped_affixes, point_rules):
+    """
+    Remove affixes which are dominated by another affix of the same group,
+    i.e. the other affix is at least as good for every stat that is worth points.
+    Craft recipes are compared the same way, since only one recipe is ever rolled.
+    """
+    # Higher is better for stats with positive thresholds, lower is better for negative thresholds.
+    # Stats used both ways have to match exactly.
+    directions = {}
+    for point_rule in point_rules:
+        _, positive, negative = compile_point_rule(point_rule)
+        for stat in point_rule.stats:
+            if positive or negative:
+                directions.setdefault(stat, set()).update(rule_directions(positive, negative))
+
+    def stat_vector(affixes):
+        vector = []
+        for stat, direction in directions.items():
+            value = sum(affix.values[stat] for affix in affixes)
+            if direction == {1}:
+                vector.append((value, value))
+            elif direction == {-1}:
+                vector.append((-value, -value))
+            else:
+                vector.append((value, -value))
+        return vector
+
+    def dominates(a, b):
+        return all(ua >= ub and la >= lb for (ua, la), (ub, lb) in zip(a, b))
+
+    def undominated(options, vectors):
+        kept = []
+        for i, (option, vector) in enumerate(zip(options, vectors)):
+            # Ties keep the first affix
+            if any(dominates(other, vector) and (j < i or not dominates(vector, other))
+                   for j, other in enumerate(vectors) if j != i):
+                continue
+            kept.append(option)
+        return kept
+
+    pruned = {}
+    for category in ('prefixes', 'suffixes'):
+        pruned[category] = [undominated(group, [stat_vector([affix]) for affix in group])
+                            for group in grouped_affixes[category]]
+    recipes = grouped_affixes['crafts']
+    pruned['crafts'] = undominated(recipes, [stat_vector(recipe) for recipe in recipes])
+    return pruned
+
+def count_affix_choices(grouped_affixes):
+    """Number of ways to pick one affix from every prefix & suffix group and one craft recipe."""
+    choices = prod(len(group) for group in grouped_affixes['prefixes'])
+    choices *= prod(len(group) for group in grouped_affixes['suffixes'])
+    return choices * max(1, len(grouped_affixes['crafts']))
+
 def group_affixes(region):
     """Generate list of grouped (in list) affixes."""
     magic_grouped_affixes = {} # All affixes
@@ -293,20 +1936,23 @@ def sort_affixes_by_group(affixes):
     rare = {} # Only rare affixes
 
     for affix in affixes:
-        group = affix.fields['group']
+        group = affix.group
         if group not in magic:
             magic[group] = []
         magic[group].append(affix)
 
         # If not magic only, also add to rare
-        if not affix.fields['magic_only']:
+        if not affix.magic_only:
             if group not in rare:
                 rare[group] = []
             rare[group].append(affix)
 
     return list(magic.values()), list(rare.values())
     
-def iter_affixes(NP, NS, NA, crafted, grouped_affixes):
+def iter_affixes(NP, NS, NA, crafted, grouped_affixes, shard=None):
+    # shard = (start, stop) only yields the items for that slice of the prefix group combinations
+    if shard is None:
+        shard = (0, None)
     grouped_unfixes = [] # Will remain empty if NA == 0
     if crafted:
         NC = 1
@@ -314,7 +1960,7 @@ def iter_affixes(NP, NS, NA, crafted, grouped_affixes):
         NC = 0
     p_idx_range = range(len(grouped_affixes['prefixes']))
     s_idx_range = range(len(grouped_affixes['suffixes']))
-    for p_idxs in combinations(p_idx_range, NP):
+    for p_idxs in islice(combinations(p_idx_range, NP), *shard):
         PGs = [grouped_affixes['prefixes'][i] for i in p_idxs]
         # Other groups can be used for random craft affixes
         if NA:
@@ -342,8 +1988,88 @@ def iter_affixes(NP, NS, NA, crafted, grouped_affixes):
                                 
 
 
-def build(verbose=False):
-    rules, regions = learn_regions(verbose=verbose)
+def iter_affix_indices(NP, NS, NA, crafted, table, shard=None, block_size=4096):
+    """
+    Index array version of iter_affixes: yields blocks of items, each item being a row of scoring table row indices.
+    Blocks hold at least block_size items, and at most about twice that
+    (unless a single prefix/suffix choice expands into more items than that).
+    Enumerates exactly the same items as iter_affixes (including shards).
+    """
+    if shard is None:
+        shard = (0, None)
+    groups = table.prefix_groups + table.suffix_groups
+
+    def choose(group_ids, n, shard=(0, None)):
+        # All ways to pick one affix from each of n distinct groups
+        # -> (rows, group ids) arrays with one choice per row
+        rows = []
+        ids = []
+        for chosen in islice(combinations(group_ids, n), *shard):
+            for picks in product(*(groups[g] for g in chosen)):
+                rows.append(picks)
+                ids.append(chosen)
+        return (np.array(rows, dtype=np.intp).reshape(len(rows), n),
+                np.array(ids, dtype=np.intp).reshape(len(ids), n))
+
+    def cross(a, b):
+        return np.hstack([np.repeat(a, len(b), axis=0), np.tile(b, (len(a), 1))])
+
+    Nprefix_groups = len(table.prefix_groups)
+    prefix_rows, prefix_ids = choose(range(Nprefix_groups), NP, shard)
+    suffix_rows, suffix_ids = choose(range(Nprefix_groups, len(groups)), NS)
+    # Random craft affixes can come from any prefix or suffix group not already used
+    random_rows, random_ids = choose(range(len(groups)), NA)
+    if crafted:
+        recipe_rows = np.array(table.recipes, dtype=np.intp).reshape(len(table.recipes), 1)
+    else:
+        recipe_rows = np.zeros((1, 0), dtype=np.intp)
+
+    # Every suffix choice expands into (up to) this many items,
+    # so take as many suffix choices at a time as fit in one block
+    expansion = max(1, len(random_rows)) * len(recipe_rows)
+    step = max(1, block_size // max(1, expansion))
+
+    pending = []
+    Npending = 0
+    for p_rows, p_ids in zip(prefix_rows, prefix_ids):
+        for start in range(0, len(suffix_rows), step):
+            ps_rows = cross(p_rows[None, :], suffix_rows[start:start+step])
+            ps_ids = cross(p_ids[None, :], suffix_ids[start:start+step])
+            if NA:
+                # Pair every prefix/suffix choice with the random affixes from other groups
+                clash = (random_ids[None, :, :, None] == ps_ids[:, None, None, :]).any(axis=(2, 3))
+                i, j = np.nonzero(~clash)
+                ps_rows = np.hstack([ps_rows[i], random_rows[j]])
+            block = cross(ps_rows, recipe_rows)
+            if len(block):
+                pending.append(block)
+                Npending += len(block)
+            if Npending >= block_size:
+                yield np.vstack(pending)
+                pending = []
+                Npending = 0
+    if pending:
+        yield np.vstack(pending)
+
+def parse_points_method(spec):
+    """
+    Max points method for every item type, from a spec like 'clusters' (all item types)
+    or 'clusters,RARE=mitm' (RARE items with mitm, the others with clusters).
+    """
+    default = 'auto'
+    methods = {}
+    for part in spec.split(','):
+        if '=' in part:
+            item_type, name = part.split('=', 1)
+            if item_type not in ITEM_TYPES:
+                raise ValueError(f"Unknown item type {item_type} in points method {spec} (should be one of {', '.join(ITEM_TYPES)})")
+            methods[item_type] = name
+        else:
+            default = part
+    return {item_type: methods.get(item_type, default) for item_type in ITEM_TYPES}
+
+def build(verbose=False, points_method='auto', points_budget=None, points_seed=0, region_cache=True, points_cache=True):
+    rules, regions = learn_regions(verbose=verbose, cache_dir=CACHE_DIR if region_cache else None)
 
     point_rules = write_points(rules)
 
@@ -354,9 +2080,15 @@ def build(verbose=False):
 
     # separate magic-only affixes from rare/magic affixes
     
-    scale_bars = (write_max_points(regions, 'MAG', verbose=verbose) + \
-                  write_max_points(regions, 'RARE', verbose=verbose) + \
-                  write_max_points(regions, 'CRAFT', verbose=verbose) )
+    # Solve all regions of all item types together, on one pool of workers
+    problems = {item_type: prepare_max_points(regions, item_type, verbose=verbose) for item_type in ITEM_TYPES}
+    solve_max_points(list(chain(*problems.values())), method=parse_points_method(points_method),
+                     cache_file=MAX_POINTS_CACHE if points_cache else None,
+                     frontier_file=FRONTIER_CACHE if points_cache else None,
+                     budget=points_budget, seed=points_seed, verbose=verbose)
+    scale_bars = []
+    for item_type in ITEM_TYPES:
+        scale_bars += write_max_points(problems[item_type], verbose=verbose)
 
     header = 'ItemDisplay[MAG OR RARE OR CRAFT]: %NAME%{%NAME%%CL%%LIGHT_GRAY%Affix Quality:%CL%}%CONTINUE%'
 